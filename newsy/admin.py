@@ -28,6 +28,7 @@ from cms.utils.plugins import get_placeholders, get_placeholders
 
 from newsy.forms import NewsItemAddForm, NewsItemForm
 from newsy.models import NewsItem, NewsItemThumbnail
+from newsy.placeholders import bump_placeholder_version
 
 if 'reversion' in settings.INSTALLED_APPS:
     _REVERSION = True
@@ -394,6 +395,7 @@ class NewsItemAdmin(ModelAdmin):
                     placeholder=placeholder, position=CMSPlugin.objects.filter(
                         placeholder=placeholder).count())
             plugin.save()
+            bump_placeholder_version(placeholder.pk)
             if _REVERSION:
                 make_revision_with_plugins(item, request.user,
                         '%(plugin_name)s plugin added to %(placeholder)s' % {
@@ -410,6 +412,7 @@ class NewsItemAdmin(ModelAdmin):
                     placeholder=parent.placeholder, parent=parent,
                     position=CMSPlugin.objects.filter(parent=parent).count())
             plugin.save()
+            bump_placeholder_version(parent.placeholder_id)
             if _REVERSION:
                 make_revision_with_plugins(item, request.user,
                         '%(plugin_name)s plugin added to plugin '
@@ -511,6 +514,8 @@ class NewsItemAdmin(ModelAdmin):
             response = plugin_admin.change_view(request, unicode(plugin_id))
 
         if request.method == "POST" and plugin_admin.object_successfully_changed:
+            bump_placeholder_version(plugin.placeholder_id)
+
             # if reversion is installed, save version of the page plugins
             if _REVERSION and item:
                 make_revision_with_plugins(item, request.user,
@@ -559,6 +564,7 @@ class NewsItemAdmin(ModelAdmin):
                 return HttpResponseBadRequest("Invalid target placeholder")
 
             placeholder = item.placeholders.get(slot=slot)
+            old_placeholder_id = plugin.placeholder_id
 
             plugin.placeholder = placeholder
             plugin.position = CMSPlugin.objects.filter(
@@ -569,6 +575,8 @@ class NewsItemAdmin(ModelAdmin):
             for descendant in plugin.get_descendants():
                 descendant.placeholder = placeholder
                 descendant.save()
+            bump_placeholder_version(old_placeholder_id)
+            bump_placeholder_version(placeholder.pk)
 
         # Reordering plugins in a slot
         if 'ids' in request.POST:
@@ -583,6 +591,8 @@ class NewsItemAdmin(ModelAdmin):
                 if plugin.position != position:
                     plugin.position = position
                     plugin.save()
+            if item is not None:
+                bump_placeholder_version(plugin.placeholder_id)
 
         if item and _REVERSION:
             make_revision_with_plugins(item, request.user,
@@ -607,6 +617,7 @@ class NewsItemAdmin(ModelAdmin):
                     _("You do not have permission to remove a plugin"))
 
         plugin.delete()
+        bump_placeholder_version(plugin.placeholder_id)
         comment = "%(plugin_name)s plugin at position %(position)s in " \
                 "%(placeholder)s was deleted." % {
                     'plugin_name': unicode(plugin_pool.get_plugin(
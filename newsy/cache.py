@@ -0,0 +1,156 @@
+from logging import getLogger
+from threading import local
+from time import time
+
+from django.core.cache import cache
+from django.core.signals import got_request_exception, request_finished, \
+    request_started
+from django.db import close_connection, transaction
+from django.dispatch import receiver
+
+
+
+log = getLogger('newsy.cache')
+
+# Memcached treats timeouts above 30 days as timestamps
+MAX_TIMEOUT = 60 * 60 * 24 * 30
+
+_deferred = local()
+
+def _generation_key(name):
+    return 'newsy:generation:%s' % (name,)
+
+def _new_generation(name):
+    """
+    Starts a generation counter from the current time so that values cached
+    under a counter that has since been evicted can never match it again.
+    """
+    key = _generation_key(name)
+    cache.add(key, int(time() * 1000), MAX_TIMEOUT)
+    return cache.get(key)
+
+def get_generation(name):
+    return cache.get(_generation_key(name)) or _new_generation(name)
+
+def bump_generation(name):
+    """
+    Invalidates every value cached with ``set_versioned`` under the generation
+    counter ``name``.
+    """
+    log.debug('bump_generation(%s)' % (name,))
+    try:
+        return cache.incr(_generation_key(name))
+    except ValueError:
+        return _new_generation(name)
+
+def get_versioned(name, key):
+    """
+    Returns a ``(generation, value)`` tuple for ``key`` using a single cache
+    round trip. The value is ``None`` when it is missing or was cached under
+    an older generation of the counter ``name``.
+    """
+    generation_key = _generation_key(name)
+    values = cache.get_many([generation_key, key])
+    generation = values.get(generation_key, None)
+    if generation is None:
+        return _new_generation(name), None
+    cached = values.get(key, None)
+    if cached is None or cached[0] != generation:
+        return generation, None
+    return generation, cached[1]
+
+def set_versioned(key, generation, value, timeout=None):
+    if timeout is None:
+        timeout = MAX_TIMEOUT
+    cache.set(key, (generation, value), timeout)
+
+def _generations(names, values):
+    return tuple(values.get(_generation_key(name), None) or
+                 _new_generation(name) for name in names)
+
+def get_generations(names):
+    """
+    Returns the values of the generation counters ``names`` as a tuple.
+    """
+    return _generations(names, cache.get_many([_generation_key(name)
+                                               for name in names]))
+
+def get_multi_versioned(names, key):
+    """
+    Like ``get_versioned`` for a value depending on several generation
+    counters, still using a single cache round trip. The generation is a
+    tuple of the counters' values.
+    """
+    values = cache.get_many([_generation_key(name) for name in names] + [key])
+    generation = _generations(names, values)
+    cached = values.get(key, None)
+    if cached is None or cached[0] != generation:
+        return generation, None
+    return generation, cached[1]
+
+def acquire_lock(name, timeout=30):
+    """
+    Returns whether the lock ``name`` was free and is now held, for at most
+    ``timeout`` seconds should its holder die before ``release_lock``.
+    """
+    return cache.add('newsy:lock:%s' % (name,), 1, timeout)
+
+def release_lock(name):
+    cache.delete('newsy:lock:%s' % (name,))
+
+def _deferring():
+    return getattr(_deferred, 'in_request', False) and transaction.is_managed()
+
+def on_commit(func, *args):
+    """
+    Calls ``func(*args)`` once the changes of the current transaction are
+    visible to other requests. In a request running a managed transaction,
+    such as an admin view, the call waits for the end of the request, after
+    the view or the transaction middleware committed, and is dropped if the
+    request raised since its transaction was rolled back. Outside of a
+    request, for example in management commands, it runs right away.
+    """
+    if _deferring():
+        _deferred.calls.append((func, args))
+    else:
+        func(*args)
+
+def on_commit_batch(func, values):
+    """
+    Like ``on_commit`` for a ``func`` taking a set: the ``values`` of every
+    call made before the commit are merged and ``func`` is called only once.
+    """
+    if not _deferring():
+        func(set(values))
+        return
+    batch = _deferred.batches.get(func, None)
+    if batch is None:
+        batch = _deferred.batches[func] = set()
+        _deferred.calls.append((func, (batch,)))
+    batch.update(values)
+
+def _reset_deferred(in_request):
+    _deferred.in_request = in_request
+    _deferred.calls = []
+    _deferred.batches = {}
+
+@receiver(request_started)
+def start_deferring(**kwargs):
+    _reset_deferred(True)
+
+@receiver(got_request_exception)
+def discard_deferred(**kwargs):
+    _reset_deferred(True)
+
+@receiver(request_finished)
+def run_deferred(**kwargs):
+    calls = getattr(_deferred, 'calls', [])
+    _reset_deferred(False)
+    for func, args in calls:
+        try:
+            func(*args)
+        except Exception:
+            log.exception('Deferred call to %r failed' % (func,))
+    if calls:
+        # The request's connection is already closed, close the one opened
+        close_connection()
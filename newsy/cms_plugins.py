@@ -8,7 +8,9 @@ from cms.plugin_pool import plugin_pool
 
 from tagging.models import TaggedItem, Tag
 
-from newsy.models import LatestNewsPlugin, NewsItem
+from newsy.models import LatestNewsPlugin, NewsItem, latest_news_generation
+from newsy.pagecache import record_dependencies
+from newsy.surrogate import latest_key, record_surrogate_keys
 
 
 
@@ -22,6 +24,12 @@ class CMSLatestNewsPlugin(CMSPluginBase):
     def render(self, context, instance, placeholder):
         log.debug('CMSLatestNewsPlugin.render(instance=%s)' % 
                   (unicode(instance),))
+        names = instance.get_tag_names()
+        record_dependencies(context.get('request', None), *[
+            latest_news_generation(name) for name in names
+        ] or [latest_news_generation()])
+        record_surrogate_keys(context.get('request', None), *[
+            latest_key(name) for name in names] or [latest_key()])
         context.update({
             'object': instance})
         return context
@@ -1,7 +1,59 @@
 from django.utils.feedgenerator import Rss201rev2Feed
+from django.utils.six import StringIO
+from django.utils.xmlutils import SimplerXMLGenerator
 
 class CustomFeedGenerator(Rss201rev2Feed):
     def add_item_elements(self, handler, item):
         super(CustomFeedGenerator, self).add_item_elements(handler, item)
         handler.addQuickElement(u"carousel", item['carousel'])
         handler.addQuickElement(u"thumbnail", item['thumbnail'])
+
+class StreamingFeedMixin(object):
+    """
+    Renders the channel and then each batch of items as soon as it is
+    available so that only one batch is held in memory at a time.
+    """
+    latest_date = None
+
+    def latest_post_date(self):
+        if self.latest_date is not None:
+            return self.latest_date
+        return super(StreamingFeedMixin, self).latest_post_date()
+
+    def _render(self, encoding, write, *args):
+        out = StringIO()
+        write(SimplerXMLGenerator(out, encoding), *args)
+        return out.getvalue()
+
+    def _write_start(self, handler):
+        handler.startDocument()
+        handler.startElement(u"rss", self.rss_attributes())
+        handler.startElement(u"channel", self.root_attributes())
+        self.add_root_elements(handler)
+
+    def _write_batch(self, handler, items):
+        for item in items:
+            handler.startElement(u"item", self.item_attributes(item))
+            self.add_item_elements(handler, item)
+            handler.endElement(u"item")
+
+    def _write_end(self, handler):
+        self.endChannelElement(handler)
+        handler.endElement(u"rss")
+
+    def stream(self, batches, encoding):
+        """
+        Returns an iterator over the feed document for use with a
+        StreamingHttpResponse. ``batches`` is an iterable of lists of items
+        in the format of ``self.items``.
+        """
+        yield self._render(encoding, self._write_start)
+        for items in batches:
+            yield self._render(encoding, self._write_batch, items)
+        yield self._render(encoding, self._write_end)
+
+class StreamingRss201rev2Feed(StreamingFeedMixin, Rss201rev2Feed):
+    pass
+
+class StreamingCustomFeedGenerator(StreamingFeedMixin, CustomFeedGenerator):
+    pass
@@ -1,17 +1,156 @@
 from datetime import date
+from calendar import timegm
+from copy import copy
+from hashlib import md5
 
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.contrib.syndication.views import Feed
 from django.core.urlresolvers import reverse
+from django.db.models import Max, Q
+from django.http import HttpResponse, HttpResponseNotModified, \
+    StreamingHttpResponse
+from django.utils.encoding import smart_str
+from django.utils.http import http_date, parse_http_date_safe
 
-from tagging.models import TaggedItem, Tag
-
-from newsy.models import NewsItem, NewsItemThumbnail
-from newsy.feedgenerator import CustomFeedGenerator
+from newsy.cache import get_versioned, set_versioned
+from newsy.models import NewsItem, NewsItemTag, NewsItemThumbnail
+from newsy.surrogate import add_surrogate_keys, feed_key, tag_key
+from newsy.feedgenerator import CustomFeedGenerator, \
+    StreamingRss201rev2Feed, StreamingCustomFeedGenerator
 
 _current_site = Site.objects.get_current
 
 class RssNewsItemFeed(Feed):
+    """
+    Serves the rendered feed from the cache with an ETag and a Last-Modified
+    header taken from the newest publication date, answering conditional
+    requests with a 304. The cache is invalidated when news items change.
+    
+    A ``limit`` of 0 puts every published item in the feed. Streaming feeds
+    are written in batches of ``stream_batch_size`` items and bypass the
+    cache, which makes them suitable for very deep feeds.
+    """
+    limit = 5
+    streaming = False
+    streaming_feed_type = StreamingRss201rev2Feed
+    stream_batch_size = 100
+    item_batch = None
+
+    def __init__(self, limit=None, streaming=False):
+        if limit is not None:
+            self.limit = limit
+        self.streaming = streaming
+
+    def __call__(self, request, *args, **kwargs):
+        obj = self.get_object(request, *args, **kwargs)
+        latest = self.get_queryset(obj).aggregate(
+            latest=Max('publication_date'))['latest']
+        last_modified = None
+        if latest is not None:
+            last_modified = timegm(latest.utctimetuple())
+
+        if self.streaming:
+            if self._not_modified(request, None, last_modified):
+                response = HttpResponseNotModified()
+            else:
+                response = self.stream(request, obj, latest)
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            return add_surrogate_keys(response, self.get_surrogate_keys(obj),
+                                      request)
+
+        key = 'newsy:feed:%s:%d:%s:%s' % (self.__class__.__name__,
+            self.limit, md5(smart_str(obj or '')).hexdigest(),
+            settings.SITE_ID,)
+        generation, cached = get_versioned('feeds', key)
+        if cached is None or cached['last_modified'] != last_modified:
+            response = super(RssNewsItemFeed, self).__call__(request, *args,
+                                                             **kwargs)
+            cached = {
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'etag': '"%s"' % (md5(response.content).hexdigest(),),
+                'last_modified': last_modified,
+            }
+            set_versioned(key, generation, cached,
+                          getattr(settings, 'NEWSY_FEED_CACHE_TIMEOUT', None))
+
+        if self._not_modified(request, cached['etag'], last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(cached['content'],
+                                    content_type=cached['content_type'])
+        response['ETag'] = cached['etag']
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return add_surrogate_keys(response, self.get_surrogate_keys(obj),
+                                  request)
+
+    def get_surrogate_keys(self, obj):
+        if obj:
+            return [tag_key(obj)]
+        return [feed_key()]
+
+    def _not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            return etag is not None and etag in [
+                value.strip() for value in if_none_match.split(',')]
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return (last_modified is not None and if_modified_since is not None
+                and last_modified <= if_modified_since)
+
+    def stream(self, request, obj, latest):
+        """
+        Returns a StreamingHttpResponse writing the feed one batch of items
+        at a time. Each batch is rendered by a copy of this feed so that the
+        item attributes go through the regular syndication machinery.
+        """
+        channel = copy(self)
+        channel.feed_type = self.streaming_feed_type
+        channel.item_batch = []
+        feed = channel.get_feed(obj, request)
+        feed.latest_date = latest
+
+        def batches():
+            for items in self.iter_batches(obj):
+                renderer = copy(channel)
+                renderer.item_batch = self.prepare_items(items)
+                yield renderer.get_feed(obj, request).items
+
+        return StreamingHttpResponse(feed.stream(batches(), 'utf-8'),
+                                     content_type=feed.mime_type)
+
+    def iter_batches(self, obj):
+        """
+        Yields the items of the feed in lists of ``stream_batch_size``, paging
+        through the queryset on (publication_date, pk) so that every batch is
+        a cheap indexed query. Tag feeds page through the tag index on
+        (publication_date, newsitem) instead.
+        """
+        field = 'newsitem' if obj else 'pk'
+        qs = self.get_queryset(obj).order_by('-publication_date', '-' + field)
+        remaining = self.limit or None
+        last = None
+        while remaining is None or remaining > 0:
+            size = self.stream_batch_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            page = qs
+            if last is not None:
+                page = page.filter(Q(publication_date__lt=last.publication_date)
+                    | Q(publication_date=last.publication_date,
+                        **{field + '__lt': last.serializable_value(field)}))
+            rows = list(page[:size])
+            if rows:
+                yield NewsItemTag.objects.get_items(rows) if obj else rows
+            if len(rows) < size:
+                break
+            last = rows[-1]
+
     def title(self, obj=None):
         if not obj:
             return u'Latest news for %s' % (_current_site().name,)
@@ -40,12 +179,38 @@ class RssNewsItemFeed(Feed):
             return [str(obj)]
         return []
     
+    def get_queryset(self, obj):
+        """
+        Returns the published items or, for a tag feed, the tag index rows of
+        the items with that tag, which carry the same publication_date.
+        """
+        if obj:
+            return NewsItemTag.objects.tagged([obj])
+        return NewsItem.site_objects.filter(published=True)
+    
     def items(self, obj):
-        qs = NewsItem.site_objects.filter(published=True)
+        if self.item_batch is not None:
+            return self.item_batch
         
+        qs = self.get_queryset(obj)
+        if self.limit > 0:
+            qs = qs[:self.limit]
         if obj:
-            return TaggedItem.objects.get_by_model(qs, [obj])[:5]
-        return qs[:5]
+            return self.prepare_items(NewsItemTag.objects.get_items(qs))
+        return self.prepare_items(list(qs))
+    
+    def prepare_items(self, items):
+        # Load the tags of every item at once for item_categories
+        tags = {}
+        for newsitem_id, name in NewsItemTag.objects.filter(
+                site=settings.SITE_ID,
+                newsitem__in=[item.pk for item in items]).order_by(
+                    'tag__name').values_list('newsitem', 'tag__name'):
+            tags.setdefault(newsitem_id, []).append(name)
+        for item in items:
+            item.feed_tags = tags.get(item.pk, [])
+        
+        return items
     
     def item_title(self, item):
         return item.title
@@ -60,18 +225,22 @@ class RssNewsItemFeed(Feed):
         return item.publication_date
     
     def item_categories(self, item):
-        return map(lambda t: t.name,
-                   Tag.objects.get_for_object(item))
+        return item.feed_tags
     
 class RssCascadeNewsFeed(RssNewsItemFeed):
     feed_type = CustomFeedGenerator
+    streaming_feed_type = StreamingCustomFeedGenerator
+    limit = 25
 
-    def items(self, obj):
-        qs = NewsItem.site_objects.filter(published=True)
+    def prepare_items(self, items):
+        items = super(RssCascadeNewsFeed, self).prepare_items(items)
 
-        if obj:
-            return TaggedItem.objects.get_by_model(qs, [obj])[:25]
-        return qs[:25]
+        thumbnails = dict((thumbnail.news_item_id, thumbnail) for thumbnail in
+                          NewsItemThumbnail.objects.filter(news_item__in=items))
+        for item in items:
+            item.feed_thumbnail = thumbnails.get(item.pk, None)
+
+        return items
 
     def item_title(self, item):
         return item.get_short_title()
@@ -80,8 +249,12 @@ class RssCascadeNewsFeed(RssNewsItemFeed):
         thumbnail = ''
         carousel = ''
 
-        if obj.thumbnail:
-            carousel = 'http://one.arch.tamu.edu%s' % (unicode(obj.thumbnail.get_news_banner_url()),)
-            thumbnail = 'http://one.arch.tamu.edu%s' % (unicode(obj.thumbnail.get_thumbnail_medium_url()),)
+        if obj.feed_thumbnail:
+            if not obj.feed_thumbnail.banner_url:
+                # thumbnails saved before the urls were stored get them filled
+                # in once, the next renders read the stored values
+                obj.feed_thumbnail.update_absolute_urls()
+            carousel = obj.feed_thumbnail.banner_url
+            thumbnail = obj.feed_thumbnail.medium_url
 
         return {'thumbnail': thumbnail, 'carousel': carousel}
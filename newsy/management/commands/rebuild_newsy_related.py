@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from newsy.models import NewsItem, RelatedNewsItem
+
+
+
+class Command(NoArgsCommand):
+    help = 'Recomputes the related items of every news item on each of its sites.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        for item in NewsItem.objects.all().iterator():
+            for site_id in item.sites.values_list('pk', flat=True):
+                RelatedNewsItem.objects.rebuild(item, site_id)
+            count += 1
+        self.stdout.write('Rebuilt the related items of %d news items\n' % (count,))
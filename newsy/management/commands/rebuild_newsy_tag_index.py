@@ -0,0 +1,17 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from newsy.models import NewsItem, NewsItemTag
+
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the tag index of every news item from its tags and sites.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        for item in NewsItem.objects.all().iterator():
+            with transaction.commit_on_success():
+                NewsItemTag.objects.sync(item)
+            count += 1
+        self.stdout.write('Rebuilt the tag index of %d news items\n' % (count,))
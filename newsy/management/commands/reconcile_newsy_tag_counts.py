@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from newsy.models import TagCount
+
+
+
+class Command(NoArgsCommand):
+    help = 'Recomputes the per site tag counts from the tag index.'
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success():
+            changed = TagCount.objects.recount()
+        self.stdout.write('Corrected %d tag counts\n' % (changed,))
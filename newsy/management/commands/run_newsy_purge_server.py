@@ -0,0 +1,62 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from urlparse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+
+class PurgeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request with the server's ``method`` with a 200 and writes
+    the path and surrogate keys it received to the command's output.
+    """
+    def __getattr__(self, name):
+        if name.startswith('do_') and name[3:] == self.server.method:
+            return self.handle_purge
+        raise AttributeError(name)
+    
+    def handle_purge(self):
+        header = getattr(settings, 'NEWSY_SURROGATE_KEY_HEADER',
+                         'Surrogate-Key')
+        self.server.stdout.write('%s %s %s: %s\n' % (self.command, self.path,
+            header, self.headers.get(header, ''),))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        pass
+
+class Command(BaseCommand):
+    args = '[addr:port]'
+    help = ('Runs a stand-in for the caching proxy on NEWSY_PURGE_URL that '
+            'prints the surrogate keys of the purges it receives.')
+
+    def handle(self, addrport='', *args, **options):
+        if args:
+            raise CommandError('Usage is run_newsy_purge_server %s' %
+                               (self.args,))
+        url = urlparse(getattr(settings, 'NEWSY_PURGE_URL',
+                               'http://127.0.0.1:6081/'))
+        addr, port = url.hostname or '127.0.0.1', url.port or 80
+        if addrport:
+            addr, _, port = addrport.rpartition(':')
+            addr = addr or '127.0.0.1'
+        try:
+            port = int(port)
+        except ValueError:
+            raise CommandError('%r is not a valid port number' % (port,))
+        
+        method = getattr(settings, 'NEWSY_PURGE_METHOD', 'PURGE')
+        server = HTTPServer((addr, port), PurgeRequestHandler)
+        server.method = method
+        server.stdout = self.stdout
+        self.stdout.write('Waiting for %s requests on %s:%d\n' % (method, addr,
+                                                                  port,))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
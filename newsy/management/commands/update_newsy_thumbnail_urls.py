@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from newsy.models import NewsItemThumbnail
+
+
+
+class Command(NoArgsCommand):
+    help = 'Stores the absolute urls of the thumbnails that have none yet.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        for thumbnail in NewsItemThumbnail.objects.filter(
+                banner_url='').iterator():
+            thumbnail.update_absolute_urls()
+            count += 1
+        self.stdout.write('Updated the urls of %d thumbnails\n' % (count,))
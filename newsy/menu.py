@@ -1,84 +1,317 @@
-import re
+from datetime import date
+from logging import getLogger
 
+from django.conf import settings
+from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
+from django.utils.encoding import force_unicode
+from django.utils.translation import override
 
 from menus.base import NavigationNode, Modifier
 from menus.menu_pool import menu_pool
 from django.utils.translation import ugettext_lazy as _
 from cms.menu_bases import CMSAttachMenu
+from cms.utils import get_language_from_request
 
-from tagging.models import Tag
+from newsy.cache import acquire_lock, bump_generation, get_versioned, \
+    release_lock, set_versioned
+from newsy.models import NewsItem, TagCount
 
-from newsy.models import NewsItem
 
 
+log = getLogger('newsy.menu')
+
+def site_tag_counts(site_id):
+    return dict(TagCount.objects.filter(site=site_id).values_list('tag__name',
+                                                                  'count'))
+
+def build_archive(qs, site_id=None):
+    """
+    Collects everything the news menu needs from the published items in ``qs``
+    with two queries: one for the item fields and one for the site's tag
+    counts.
+
+    Returns a dictionary with the tag usage counts and, keyed by item pk, a
+    ``(publication_date, title, menu title, slug)`` tuple.
+    """
+    items = {}
+    for pk, title, short_title, slug, pub in qs.values_list('pk', 'title',
+            'short_title', 'slug', 'publication_date'):
+        if pub is None:
+            continue
+        items[pk] = (pub, title, short_title or title, slug)
+
+    return {
+        'tags': site_tag_counts(site_id or settings.SITE_ID),
+        'items': items,
+    }
+
+def patch_archive(archive, pk, entry=None, tags=None):
+    """
+    Replaces the item ``pk`` of an archive returned by ``build_archive`` with
+    ``entry``, or removes it when ``entry`` is ``None``, along with the tag
+    counts when ``tags`` is given. Returns the item's previous entry.
+    """
+    old = archive['items'].pop(pk, None)
+    if entry is not None:
+        archive['items'][pk] = entry
+    if tags is not None:
+        archive['tags'] = tags
+    return old
+
+def _node(title, url, id, parent_id, kind):
+    return NavigationNode(title, url, id, parent_id,
+                          attr={'newsy_kind': kind})
+
+def _date_ids(pub):
+    year_id = 'year_%04d' % (pub.year,)
+    month_id = '%s_month_%02d' % (year_id, pub.month,)
+    return year_id, month_id, '%s_day_%02d' % (month_id, pub.day,)
+
+def _tag_nodes(tags):
+    tags = sorted(tags.iteritems())
+    tags.sort(key=lambda t: t[1], reverse=True)
+    return [_node(_(name), reverse('tag-view', kwargs={'tag': name}),
+                  'tag_%s' % (name,), 'tags', 'tag') for name, count in tags]
+
+def _year_node(year):
+    return _node(year, reverse('archive-view', kwargs={'year': year}),
+                 'year_%04d' % (year,), None, 'year')
+
+def _month_node(year, month):
+    year_id, month_id, day_id = _date_ids(date(year, month, 1))
+    return _node(date(year, month, 1).strftime('%B'), reverse('month-view',
+        kwargs={'year': year, 'month': month}), month_id, year_id, 'month')
+
+def _day_node(year, month, day):
+    year_id, month_id, day_id = _date_ids(date(year, month, day))
+    return _node(day, reverse('date-view', kwargs={'year': year,
+        'month': month, 'day': day}), day_id, month_id, 'day')
+
+def _item_node(pk, entry):
+    pub, title, menu_title, slug = entry
+    return _node(menu_title, reverse('published-item-view', kwargs={
+        'year': pub.year, 'month': pub.month, 'day': pub.day, 'slug': slug}),
+        'news_item_%d' % (pk,), _date_ids(pub)[2], 'item')
+
+def archive_nodes(archive):
+    """
+    Builds the navigation nodes for an archive returned by ``build_archive``:
+    the tags ordered by usage, the years (newest first) with their months and
+    days (oldest first) and finally the items (newest first).
+    """
+    nodes = []
+    nodes.append(_node(_('Tags'), reverse('tags-view'), 'tags', None,
+                       'tags'))
+    nodes.extend(_tag_nodes(archive['tags']))
+
+    items = sorted(archive['items'].iteritems(), key=lambda i: i[1][1])
+    items.sort(key=lambda i: i[1][0], reverse=True)
+
+    years = {}
+    for pk, (pub, title, menu_title, slug) in items:
+        days = years.setdefault(pub.year, {}).setdefault(pub.month, {})
+        days[pub.day] = days.get(pub.day, 0) + 1
+
+    for year in sorted(years, reverse=True):
+        nodes.append(_year_node(year))
+        for month in sorted(years[year]):
+            nodes.append(_month_node(year, month))
+            for day in sorted(years[year][month]):
+                nodes.append(_day_node(year, month, day))
+
+    for pk, entry in items:
+        nodes.append(_item_node(pk, entry))
+
+    return nodes
+
+def menu_cache_key(site_id, language):
+    return 'newsy:menu:3:%s:%s' % (site_id, language,)
+
+def serialize_nodes(nodes):
+    return [(force_unicode(node.title), node.url, node.id, node.parent_id,
+             node.attr['newsy_kind']) for node in nodes]
+
+def deserialize_nodes(rows):
+    return [_node(*row) for row in rows]
+
+def _insert_row(rows, node, before, start=0):
+    """
+    Inserts the serialized ``node`` before the first row from ``start`` for
+    which ``before(row)`` is true, or at the end. Returns its index.
+    """
+    row = serialize_nodes([node])[0]
+    for i in range(start, len(rows)):
+        if before(rows[i]):
+            rows.insert(i, row)
+            return i
+    rows.append(row)
+    return len(rows) - 1
+
+def _row_index(rows, node_id):
+    for i, row in enumerate(rows):
+        if row[2] == node_id:
+            return i
+
+def patch_rows(rows, archive, pk, old, entry):
+    """
+    Applies the change of the item ``pk`` from ``old`` to ``entry``, either
+    of which may be ``None``, to the serialized nodes of ``archive``, which
+    is already patched. Only the rows of the item, of its dates and of the
+    tags are replaced, each in a single pass, so nothing is sorted again but
+    the tags.
+    """
+    if old is not None:
+        item_id = 'news_item_%d' % (pk,)
+        rows[:] = [row for row in rows if row[2] != item_id]
+        for node_id in reversed(_date_ids(old[0])):
+            if not any(row[3] == node_id for row in rows):
+                rows[:] = [row for row in rows if row[2] != node_id]
+
+    if entry is not None:
+        pub, title = entry[0], entry[1]
+        year_id, month_id, day_id = _date_ids(pub)
+        # The zero padded ids sort like the dates they stand for
+        index = _row_index(rows, year_id)
+        if index is None:
+            index = _insert_row(rows, _year_node(pub.year), lambda row:
+                row[4] == 'item' or row[4] == 'year' and row[2] < year_id)
+        parent, index = index, _row_index(rows, month_id)
+        if index is None:
+            index = _insert_row(rows, _month_node(pub.year, pub.month),
+                lambda row: row[4] in ('year', 'item') or
+                row[4] == 'month' and row[2] > month_id, parent + 1)
+        if _row_index(rows, day_id) is None:
+            _insert_row(rows, _day_node(pub.year, pub.month, pub.day),
+                lambda row: row[4] != 'day' or row[2] > day_id, index + 1)
+
+        def follows(row):
+            if row[4] != 'item':
+                return False
+            other = archive['items'].get(int(row[2][len('news_item_'):]))
+            return other is not None and (other[0] < pub or
+                                          other[0] == pub and other[1] > title)
+        _insert_row(rows, _item_node(pk, entry), follows)
+
+    end = 1
+    while end < len(rows) and rows[end][4] == 'tag':
+        end += 1
+    rows[1:end] = serialize_nodes(_tag_nodes(archive['tags']))
+    return rows
+
+def _patch_cached_menu(key, language, pk, entry, tags):
+    """
+    Patches a single cached menu under its lock. Returns False when the lock
+    is held by another patch or a reader building the menu.
+    """
+    if not acquire_lock(key):
+        return False
+    try:
+        generation, cached = get_versioned('menu', key)
+        if cached is None or (entry is None and
+                              pk not in cached['archive']['items']):
+            return True
+        old = patch_archive(cached['archive'], pk, entry, tags)
+        if cached['nodes'] is not None:
+            with override(language):
+                patch_rows(cached['nodes'], cached['archive'], pk, old, entry)
+        set_versioned(key, generation, cached,
+                      getattr(settings, 'NEWSY_MENU_CACHE_TIMEOUT', None))
+        return True
+    finally:
+        release_lock(key)
+
+def patch_cached_menus(pk):
+    """
+    Applies the change of the news item ``pk``, saved or deleted, to every
+    cached menu instead of invalidating them. The item is read again so that
+    only committed changes reach the menus. Costs a query for the item and
+    its sites and one for the tag counts of each site whatever the size of
+    the archive, and the cached nodes are patched in place rather than
+    rebuilt.
+
+    Each menu is patched under a lock that readers also take while building
+    it. When the lock is taken the change could be lost, so every menu is
+    invalidated instead. Call it once the change is committed.
+    """
+    entry = None
+    site_ids = []
+    try:
+        item = NewsItem.objects.get(pk=pk)
+    except NewsItem.DoesNotExist:
+        item = None
+    if item is not None and item.published and item.publication_date:
+        site_ids = list(item.sites.values_list('pk', flat=True))
+        entry = (item.publication_date, item.title, item.get_short_title(),
+                 item.slug)
+
+    for site_id in Site.objects.values_list('pk', flat=True):
+        tags = site_tag_counts(site_id)
+        for language, name in settings.LANGUAGES:
+            if not _patch_cached_menu(menu_cache_key(site_id, language),
+                    language, pk, entry if site_id in site_ids else None,
+                    tags):
+                log.debug('patch_cached_menus(%s): conflict' % (pk,))
+                bump_generation('menu')
+                return
+
 
 class NewsyMenu(CMSAttachMenu):
     name = _('News Menu')
 
     def get_nodes(self, request):
-        qs = NewsItem.site_objects.filter(published=True)
-        nodes = []
-        nodes.append(NavigationNode(_('Tags'), reverse('tags-view'), 'tags'))
-
-        tags = Tag.objects.usage_for_queryset(qs, counts=True)
-        tags.sort(key=lambda t:t.count, reverse=True)
-        for tag in tags:
-            nodes.append(NavigationNode(_(tag.name), reverse('tag-view',
-                kwargs={'tag':tag.name}), 'tag_%s' % (tag.name,), 'tags'))
-
-        for year in qs.dates('publication_date', 'year', order='DESC'):
-            nodes.append(NavigationNode(year.year, reverse('archive-view', 
-                kwargs={'year': year.year}), year.strftime('year_%Y')))
-            for month in qs.filter(publication_date__year=year.year).dates('publication_date',
-                            'month', order='ASC'):
-                nodes.append(NavigationNode(month.strftime('%B'),
-                        reverse('month-view', kwargs={'year': month.year,
-                            'month': month.month}),
-                            month.strftime('year_%Y_month_%m'),
-                            month.strftime('year_%Y')))
-
-                for day in qs.filter(publication_date__year=month.year,
-                        publication_date__month=month.month).dates('publication_date',
-                                'day', order='ASC'):
-                    nodes.append(NavigationNode(day.day, reverse('date-view',
-                        kwargs={'year': day.year, 'month': day.month, 'day':
-                            day.day}), day.strftime('year_%Y_month_%m_day_%d'),
-                        day.strftime('year_%Y_month_%m')))
-
-        for news_item in qs:
-            pub = news_item.publication_date
-            nodes.append(NavigationNode(news_item.get_short_title(),
-                    reverse('published-item-view', kwargs={'year': pub.year,
-                        'month': pub.month, 'day': pub.day, 'slug':
-                        news_item.slug}), 'news_item_%d' % (news_item.pk,), 
-                    pub.strftime('year_%Y_month_%m_day_%d')))
+        key = menu_cache_key(settings.SITE_ID,
+                             get_language_from_request(request))
+        generation, cached = get_versioned('menu', key)
+        if cached is not None and cached['nodes'] is not None:
+            return deserialize_nodes(cached['nodes'])
 
+        # Only a menu built under the lock is stored, so no patch is lost
+        locked = acquire_lock(key)
+        try:
+            if cached is not None:
+                archive = cached['archive']
+            else:
+                archive = build_archive(
+                    NewsItem.site_objects.filter(published=True))
+            nodes = archive_nodes(archive)
+            if locked:
+                set_versioned(key, generation, {'archive': archive,
+                    'nodes': serialize_nodes(nodes)},
+                    getattr(settings, 'NEWSY_MENU_CACHE_TIMEOUT', None))
+        finally:
+            if locked:
+                release_lock(key)
         return nodes
 
 menu_pool.register_menu(NewsyMenu)
 
 class NewsCleaner(Modifier):
+    """
+    Hides the days and items of the news menu as well as the tags beyond the
+    NEWSY_MENU_VISIBLE_TAGS most used ones.
+    """
+    hidden_kinds = frozenset(['day', 'item'])
+
     def modify(self, request, nodes, namespace, root_id, post_cut, breadcrumb):
         if post_cut or breadcrumb:
             return nodes
 
-        tags = 0
-
-        filter_dates = re.compile(r'^year_\d{4}_month_\d{1,2}(_day_\d{1,2})?$')
+        tags = getattr(settings, 'NEWSY_MENU_VISIBLE_TAGS', 5)
+        hidden_kinds = self.hidden_kinds
 
         for node in nodes:
             if node.namespace != 'NewsyMenu':
                 continue
-            if node.parent_id == 'tags':
-                tags += 1
-                if tags > 5:
+            kind = node.attr.get('newsy_kind', None)
+            if kind == 'tag':
+                if tags > 0:
+                    tags -= 1
+                else:
                     node.visible = False
-                continue
-            if filter_dates.match(str(node.parent_id)):
+            elif kind in hidden_kinds:
                 node.visible = False
 
         return nodes
 
 menu_pool.register_modifier(NewsCleaner)
-
@@ -1,25 +1,36 @@
 from datetime import date
+from hashlib import md5
 from logging import getLogger
 
 from django.conf import settings
 from django.core.validators import RegexValidator
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, Max
+from django.dispatch import receiver
 from django.template.loader import select_template
+from django.test.signals import setting_changed
+from django.utils.encoding import smart_str
 from django.utils.translation import ugettext_lazy as _
 
 from cms.models import Placeholder, Page, CMSPlugin
 
 from photologue.models import ImageModel
 
+from tagging import settings as tagging_settings
 from tagging.fields import TagField as BaseTagField
 from tagging.models import TaggedItem, Tag
+from tagging.utils import parse_tag_input
+
+from newsy.cache import get_multi_versioned, set_versioned
 
 
 
 log = getLogger('newsy.models')
 
+_latest_templates = {}
+
 try:
     from south.modelsinspector import add_introspection_rules
     add_introspection_rules([], ["^newsy\.models\.TagField"])
@@ -41,13 +52,66 @@ class TagField(BaseTagField):
 class NewsItemThumbnail(ImageModel):
     news_item = models.OneToOneField('NewsItem',related_name='thumbnail',
                                   on_delete=models.CASCADE)
+    banner_url = models.CharField(_('banner url'), max_length=255, blank=True,
+                                  editable=False)
+    medium_url = models.CharField(_('medium thumbnail url'), max_length=255,
+                                  blank=True, editable=False)
     
     def __unicode__(self):
         return u'%s thumbnail' % (self.news_item.title,)
     
+    def save(self, *args, **kwargs):
+        super(NewsItemThumbnail, self).save(*args, **kwargs)
+        self.update_absolute_urls()
+    
+    def update_absolute_urls(self):
+        """
+        Stores the absolute urls of the news banner and medium thumbnail sizes
+        so that rendering a feed never goes through photologue's size handling.
+        """
+        log.debug('%s.update_absolute_urls()' % (repr(self),))
+        host = 'http://%s' % (Site.objects.get_current().domain,)
+        self.banner_url = host + unicode(self.get_news_banner_url())
+        self.medium_url = host + unicode(self.get_thumbnail_medium_url())
+        NewsItemThumbnail.objects.filter(pk=self.pk).update(
+            banner_url=self.banner_url, medium_url=self.medium_url)
+    
     class Meta:
         db_table = 'newsy_newsitem_thumbnail'
 
+def user_permission_generation(user_id):
+    return 'permissions:user:%d' % (user_id,)
+
+def cached_permission(request, item, perm_type, check):
+    """
+    Returns the result of ``check()`` for the request's user, ``item`` and
+    ``perm_type``. It is remembered for the rest of the request and for
+    NEWSY_PERMISSION_CACHE_TIMEOUT seconds across requests, or until the
+    user's groups or permissions change. Anonymous users share one entry per
+    item, which lasts until it times out or any group's permissions change.
+    """
+    user = request.user
+    key = (user.pk or 0, item.pk, perm_type)
+    if not hasattr(request, '_newsy_permissions'):
+        setattr(request, '_newsy_permissions', {})
+    elif key in request._newsy_permissions:
+        return request._newsy_permissions[key]
+    
+    timeout = getattr(settings, 'NEWSY_PERMISSION_CACHE_TIMEOUT', 60)
+    if timeout and item.pk:
+        cache_key = 'newsy:permission:%d:%d:%s' % key
+        names = ['permissions']
+        if user.pk:
+            names.append(user_permission_generation(user.pk))
+        generation, allowed = get_multi_versioned(names, cache_key)
+        if allowed is None:
+            allowed = bool(check())
+            set_versioned(cache_key, generation, allowed, timeout)
+    else:
+        allowed = bool(check())
+    request._newsy_permissions[key] = allowed
+    return allowed
+
 class NewsItem(models.Model):
     title = models.CharField(_('title'), max_length = 255)
     short_title = models.CharField(_('short title'), max_length = 255, blank = True,
@@ -76,6 +140,7 @@ class NewsItem(models.Model):
     class Meta:
         get_latest_by = 'publication_date'
         ordering = ['-publication_date','title']
+        index_together = [['slug', 'publication_date']]
     
     def __unicode__(self):
         return self.title
@@ -107,36 +172,68 @@ class NewsItem(models.Model):
             return date.today().replace(day=1)
     
     def get_related(self, max=5):
-        return TaggedItem.objects.get_related(self,
-                   NewsItem.site_objects.filter(published=True),
-                   num=max)
+        return NewsItem.objects.filter(published=True,
+            related_from__newsitem=self,
+            related_from__site=settings.SITE_ID).order_by(
+                '-related_from__score')[:max]
 
     def get_tags(self):
         return Tag.objects.get_for_object(self)
     
-    def get_next_published(self):
-        if not self.publication_date or not self.published:
-            return None
+    def get_published_neighbours(self):
+        """
+        Returns the ``(previous, next)`` published items of the current site
+        in (publication_date, pk) order, either of which may be ``None``.
+        Both are fetched with a single query the first time and remembered on
+        the instance.
+        """
+        if hasattr(self, '_published_neighbours'):
+            return self._published_neighbours
+        
+        self._published_neighbours = (None, None)
+        if not self.publication_date or not self.published or not self.pk:
+            return self._published_neighbours
         
-        try:
-            return NewsItem.site_objects.filter(
-                published=True,
-                publication_date__gt=self.publication_date).order_by(
-                    'publication_date')[0]
-        except:
-            return None
+        qn = connection.ops.quote_name
+        through = NewsItem.sites.through._meta
+        table = qn(NewsItem._meta.db_table)
+        neighbour = """
+            SELECT * FROM (SELECT '%(alias)s' AS newsy_direction, n.* FROM %(table)s n
+                INNER JOIN %(through)s s ON s.%(item)s = n.%(pk)s
+                WHERE s.%(site)s = %%s AND n.%(published)s = %%s AND
+                    (n.%(date)s %(op)s %%s OR (n.%(date)s = %%s AND
+                                              n.%(pk)s %(op)s %%s))
+                ORDER BY n.%(date)s %(order)s, n.%(pk)s %(order)s
+                LIMIT 1) %(alias)s"""
+        names = {
+            'table': table,
+            'through': qn(through.db_table),
+            'item': qn(NewsItem.sites.field.m2m_column_name()),
+            'site': qn(NewsItem.sites.field.m2m_reverse_name()),
+            'pk': qn(NewsItem._meta.pk.column),
+            'published': qn('published'),
+            'date': qn('publication_date'),
+        }
+        sql = ' UNION ALL '.join([
+            neighbour % dict(names, op='<', order='DESC', alias='previous'),
+            neighbour % dict(names, op='>', order='ASC', alias='next')])
+        params = []
+        for direction in range(2):
+            params.extend([settings.SITE_ID, True,
+                           self.publication_date, self.publication_date,
+                           self.pk])
+        
+        neighbours = dict((item.newsy_direction, item) for item in
+                          NewsItem.objects.raw(sql, params))
+        self._published_neighbours = (neighbours.get('previous', None),
+                                      neighbours.get('next', None))
+        return self._published_neighbours
+    
+    def get_next_published(self):
+        return self.get_published_neighbours()[1]
     
     def get_previous_published(self):
-        if not self.publication_date or not self.published:
-            return None
-        
-        try:
-            return NewsItem.site_objects.filter(
-                published=True,
-                publication_date__lt=self.publication_date).order_by(
-                    '-publication_date')[0]
-        except:
-            return None
+        return self.get_published_neighbours()[0]
     
     def get_cached_ancestors(self, ascending=True):
         return []
@@ -170,20 +267,23 @@ class NewsItem(models.Model):
                 placeholder = Placeholder.objects.create(slot=placeholder_name)
                 self.placeholders.add(placeholder)
                 found[placeholder_name] = placeholder
+        self._tmp_placeholders_cache = found
     
     def has_change_permission(self, request):
         opts = self._meta
         if request.user.is_superuser:
             return True
-        return request.user.has_perm(opts.app_label + '.' + opts.get_change_permission()) and \
-            self.has_generic_permission(request, "change")
+        return cached_permission(request, self, "change", lambda:
+            request.user.has_perm(opts.app_label + '.' + opts.get_change_permission()) and \
+            self.has_generic_permission(request, "change"))
     
     def has_delete_permission(self, request):
         opts = self._meta
         if request.user.is_superuser:
             return True
-        return request.user.has_perm(opts.app_label + '.' + opts.get_delete_permission()) and \
-            self.has_generic_permission(request, "delete")
+        return cached_permission(request, self, "delete", lambda:
+            request.user.has_perm(opts.app_label + '.' + opts.get_delete_permission()) and \
+            self.has_generic_permission(request, "delete"))
     
     def has_publish_permission(self, request):
         return self.has_generic_permission(request, "publish")
@@ -232,6 +332,277 @@ class NewsItem(models.Model):
                 
         return getattr(self, att_name)
 
+class NewsItemTagManager(models.Manager):
+    def tagged(self, tag_names, site_id=None, published=True):
+        """
+        Returns the index rows of the items tagged with all of ``tag_names``
+        on the site, newest first. The tag ids are resolved with a single
+        query so that the rows come from a range scan of the covering index
+        on (tag, site, published, publication_date, newsitem), which also
+        serves the ordering. Use ``get_items`` to fetch the items of a slice.
+        """
+        site_id = site_id or settings.SITE_ID
+        names = list(tag_names)
+        tag_ids = dict(Tag.objects.filter(name__in=names).values_list('name',
+                                                                      'pk'))
+        if not names or len(tag_ids) < len(set(names)):
+            return self.none()
+        
+        queryset = self.filter(tag=tag_ids[names[0]], site=site_id,
+                               published=published)
+        for name in set(names[1:]) - set(names[:1]):
+            queryset = queryset.filter(newsitem__in=self.filter(
+                tag=tag_ids[name], site=site_id).values('newsitem'))
+        return queryset.order_by('-publication_date', '-newsitem')
+    
+    def get_items(self, rows):
+        """
+        Returns the news items of the index ``rows`` in the same order with a
+        single query.
+        """
+        pks = [row.newsitem_id for row in rows]
+        items = NewsItem.objects.in_bulk(pks)
+        return [items[pk] for pk in pks if pk in items]
+    
+    def sync(self, item):
+        """
+        Rewrites the index rows of ``item`` from its tags and sites. Runs in
+        the caller's transaction, such as the admin's, so that a failed save
+        leaves no index rows behind.
+        """
+        log.debug('NewsItemTag.objects.sync(%s)' % (unicode(item),))
+        tags = list(Tag.objects.get_for_object(item))
+        site_ids = list(item.sites.values_list('pk', flat=True))
+        previous = list(self.filter(newsitem=item).values_list('tag', 'site'))
+        self.filter(newsitem=item).delete()
+        self.bulk_create([NewsItemTag(tag=tag, newsitem=item, site_id=site_id,
+                publication_date=item.publication_date,
+                published=item.published)
+            for tag in tags for site_id in site_ids])
+        TagCount.objects.recount(
+            set(tag.pk for tag in tags) | set(t for t, s in previous),
+            set(site_ids) | set(s for t, s in previous))
+
+class NewsItemTag(models.Model):
+    """
+    A narrow, per site copy of the tags of each news item along with the
+    columns the tag listings filter and order on, kept in sync from the
+    item's TagField. Migrations fill it for existing items and the
+    rebuild_newsy_tag_index command rebuilds it.
+    """
+    tag = models.ForeignKey(Tag, related_name='newsy_index')
+    newsitem = models.ForeignKey(NewsItem, related_name='tag_index')
+    site = models.ForeignKey(Site, related_name='+')
+    publication_date = models.DateTimeField(blank=True, null=True)
+    published = models.BooleanField(default=False)
+    
+    objects = NewsItemTagManager()
+    
+    class Meta:
+        db_table = 'newsy_newsitem_tag'
+        unique_together = [['tag', 'newsitem', 'site']]
+        index_together = [['tag', 'site', 'published', 'publication_date',
+                           'newsitem']]
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.tag_id, self.newsitem_id,)
+
+class TagCountManager(models.Manager):
+    def recount(self, tag_ids=None, site_ids=None):
+        """
+        Recomputes the counts of the given tags on the given sites (all of
+        them when ``None``) from the tag index with a single aggregate query.
+        Returns the number of count rows that changed. Call it in the same
+        transaction as the change of the index.
+        
+        Only the rows that changed are written. The existing rows are locked
+        first so that concurrent recounts of the same tags wait for each
+        other, and a row inserted meanwhile by another recount is updated
+        instead.
+        """
+        counts = self.all()
+        index = NewsItemTag.objects.filter(published=True)
+        if tag_ids is not None:
+            counts = counts.filter(tag__in=tag_ids)
+            index = index.filter(tag__in=tag_ids)
+        if site_ids is not None:
+            counts = counts.filter(site__in=site_ids)
+            index = index.filter(site__in=site_ids)
+        
+        existing = dict(((row.tag_id, row.site_id), row) for row in
+                        counts.select_for_update().order_by('tag', 'site'))
+        current = dict(((row['tag'], row['site']), (row['count'],
+                                                    row['latest']))
+            for row in index.values('tag', 'site').annotate(
+                count=Count('newsitem'), latest=Max('publication_date')))
+        
+        stale = [row.pk for key, row in existing.iteritems()
+                 if key not in current]
+        if stale:
+            self.filter(pk__in=stale).delete()
+        changed = len(stale)
+        
+        for (tag_id, site_id), (count, latest) in current.iteritems():
+            row = existing.get((tag_id, site_id))
+            if row is None:
+                sid = transaction.savepoint()
+                try:
+                    self.create(tag_id=tag_id, site_id=site_id, count=count,
+                                latest_publication_date=latest)
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    self.filter(tag=tag_id, site=site_id).update(count=count,
+                        latest_publication_date=latest)
+            elif (row.count, row.latest_publication_date) != (count, latest):
+                self.filter(pk=row.pk).update(count=count,
+                                              latest_publication_date=latest)
+            else:
+                continue
+            changed += 1
+        return changed
+    
+    def for_site(self, site_id=None):
+        """
+        Returns the tags used by published items on the site ordered by name,
+        each with its ``count`` like tagging's ``usage_for_queryset``.
+        """
+        tags = []
+        for row in self.filter(site=site_id or settings.SITE_ID).select_related(
+                'tag').order_by('tag__name'):
+            row.tag.count = row.count
+            tags.append(row.tag)
+        return tags
+
+class TagCount(models.Model):
+    """
+    The number of published items using each tag per site, kept up to date
+    along with the tag index. Migrations fill it for existing items and the
+    reconcile_newsy_tag_counts command repairs it.
+    """
+    tag = models.ForeignKey(Tag, related_name='newsy_counts')
+    site = models.ForeignKey(Site, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    latest_publication_date = models.DateTimeField(blank=True, null=True)
+    
+    objects = TagCountManager()
+    
+    class Meta:
+        db_table = 'newsy_tag_count'
+        unique_together = [['tag', 'site']]
+        index_together = [['site', 'count']]
+    
+    def __unicode__(self):
+        return u'%s: %d' % (self.tag_id, self.count,)
+
+def related_score(shared, publication_date, other_publication_date):
+    """
+    Scores a related item by the number of tags it shares, breaking ties in
+    favour of items published closer in time (within a month weighs about
+    half as much as a shared tag).
+    """
+    days = abs((publication_date - other_publication_date).days)
+    return shared + 1.0 / (1.0 + days / 30.0)
+
+class RelatedNewsItemManager(models.Manager):
+    def compute(self, item, site_id):
+        """
+        Returns the scores of every published item sharing a tag with ``item``
+        on the site, by item pk, with one query on the tag index.
+        """
+        if not item.published or not item.publication_date:
+            return {}
+        tag_ids = list(NewsItemTag.objects.filter(newsitem=item,
+            site=site_id).values_list('tag', flat=True))
+        if not tag_ids:
+            return {}
+        scores = {}
+        for row in NewsItemTag.objects.filter(tag__in=tag_ids, site=site_id,
+                published=True).exclude(newsitem=item).values('newsitem',
+                    'publication_date').annotate(shared=Count('tag')):
+            if row['publication_date'] is not None:
+                scores[row['newsitem']] = related_score(row['shared'],
+                    item.publication_date, row['publication_date'])
+        return scores
+    
+    def rebuild(self, item, site_id, scores=None):
+        """
+        Stores the NEWSY_RELATED_ITEMS best scoring related items of ``item``.
+        """
+        if scores is None:
+            scores = self.compute(item, site_id)
+        best = sorted(scores.iteritems(), key=lambda s: s[1], reverse=True)
+        best = best[:getattr(settings, 'NEWSY_RELATED_ITEMS', 10)]
+        self.filter(newsitem=item, site=site_id).delete()
+        self.bulk_create([RelatedNewsItem(newsitem_id=item.pk, site_id=site_id,
+                                          related_id=pk, score=score)
+                          for pk, score in best])
+    
+    def refresh(self, item, neighbours=()):
+        """
+        Recomputes the related items of ``item`` and of the items whose lists
+        it enters or leaves: those that listed it before (or the pks in
+        ``neighbours``) and those it now outscores or that have room for it,
+        best scores first. At most NEWSY_RELATED_REFRESH_LIMIT other items
+        are rebuilt per site; the others catch up when they change or with
+        the rebuild_newsy_related command.
+        """
+        log.debug('RelatedNewsItem.objects.refresh(%s)' % (unicode(item),))
+        limit = getattr(settings, 'NEWSY_RELATED_ITEMS', 10)
+        bound = getattr(settings, 'NEWSY_RELATED_REFRESH_LIMIT', 50)
+        site_ids = set(item.sites.values_list('pk', flat=True)) | set(
+            self.filter(related=item).values_list('site', flat=True))
+        for site_id in site_ids:
+            affected = list(set(neighbours) | set(self.filter(related=item,
+                site=site_id).values_list('newsitem', flat=True)))
+            scores = self.compute(item, site_id)
+            self.rebuild(item, site_id, scores)
+            
+            thresholds = dict((row['newsitem'], (row['count'], row['lowest']))
+                for row in self.filter(site=site_id, newsitem__in=scores.keys())
+                    .values('newsitem').annotate(count=Count('pk'),
+                                                 lowest=models.Min('score')))
+            for pk, score in sorted(scores.iteritems(), key=lambda s: s[1],
+                                    reverse=True):
+                if len(affected) >= bound:
+                    break
+                count, lowest = thresholds.get(pk, (0, None))
+                if pk not in affected and (count < limit or score > lowest):
+                    affected.append(pk)
+            
+            for neighbour in NewsItem.objects.filter(pk__in=affected[:bound]):
+                self.rebuild(neighbour, site_id)
+
+class RelatedNewsItem(models.Model):
+    """
+    The precomputed best related items of each news item per site, kept up
+    to date when an item's tags, sites or publication change. Migrations fill
+    it for existing items and the rebuild_newsy_related command rebuilds it.
+    """
+    newsitem = models.ForeignKey(NewsItem, related_name='related_to')
+    related = models.ForeignKey(NewsItem, related_name='related_from')
+    site = models.ForeignKey(Site, related_name='+')
+    score = models.FloatField()
+    
+    objects = RelatedNewsItemManager()
+    
+    class Meta:
+        db_table = 'newsy_newsitem_related'
+        unique_together = [['newsitem', 'related', 'site']]
+        index_together = [['newsitem', 'site', 'score']]
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.newsitem_id, self.related_id,)
+
+def latest_news_generation(tag_name=None):
+    """
+    Returns the name of the generation counter for the cached latest news of
+    plugins showing ``tag_name``, or showing all tags when it is None.
+    """
+    if tag_name is None:
+        return 'latest:all'
+    return 'latest:tag:%s' % (md5(smart_str(tag_name)).hexdigest(),)
+
 class LatestNewsPlugin(CMSPlugin):
     limit = models.PositiveSmallIntegerField(default=0)
     tags = TagField()
@@ -242,26 +613,66 @@ class LatestNewsPlugin(CMSPlugin):
         
         return 'Latest news'
     
+    def get_tag_names(self):
+        names = parse_tag_input(self.tags)
+        if tagging_settings.FORCE_LOWERCASE_TAGS:
+            names = [name.lower() for name in names]
+        return sorted(set(names))
+    
     def items(self):
+        """
+        Returns the latest published items. Their pks are cached per plugin,
+        tags, limit and site until an item with one of these tags changes, so
+        only one pk__in query is made for the items themselves.
+        """
         log.debug('%s.items()' % (repr(self),))
-        qs = NewsItem.site_objects.filter(published=True)
-        tags = Tag.objects.get_for_object(self)
-        
-        if tags:
-            qs = TaggedItem.objects.get_by_model(qs, tags)
+        names = self.get_tag_names()
+        key = 'newsy:latest:%d:%s:%d:%s' % (self.pk,
+            md5(smart_str(u','.join(names))).hexdigest(), self.limit,
+            settings.SITE_ID,)
+        generation, pks = get_multi_versioned([latest_news_generation(name)
+            for name in names] or [latest_news_generation()], key)
         
-        if self.limit > 0:
-            qs = qs[:self.limit]
+        if pks is None:
+            if names:
+                qs = NewsItemTag.objects.tagged(names).values_list('newsitem',
+                                                                   flat=True)
+            else:
+                qs = NewsItem.site_objects.filter(published=True).values_list(
+                    'pk', flat=True)
+            
+            if self.limit > 0:
+                qs = qs[:self.limit]
+            
+            pks = list(qs)
+            set_versioned(key, generation, pks,
+                getattr(settings, 'NEWSY_LATEST_CACHE_TIMEOUT', None))
         
-        return qs
+        items = NewsItem.objects.in_bulk(pks)
+        return [items[pk] for pk in pks if pk in items]
     
     @property
     def render_template(self):
+        """
+        The template for the placeholder slot, or the default one. It is
+        only looked up once per slot and process unless DEBUG is set.
+        """
         log.debug('%s.render_template()' % (repr(self),))
-        return select_template([
-            'cms/plugins/newsy/%s-latest.html' % (self.placeholder.slot.lower(),),
+        slot = self.placeholder.slot.lower()
+        if not settings.DEBUG and slot in _latest_templates:
+            return _latest_templates[slot]
+        template = select_template([
+            'cms/plugins/newsy/%s-latest.html' % (slot,),
             'cms/plugins/newsy/latest.html'])
+        _latest_templates[slot] = template
+        return template
     
     def copy_relations(self, oldinstance):
         log.debug('%s.copy_relations(%s)' % (repr(self), repr(oldinstance),))
         self.tags = oldinstance.tags
+
+@receiver(setting_changed)
+def template_settings_changed(setting, **kwargs):
+    if setting in ('DEBUG', 'TEMPLATE_DIRS', 'TEMPLATE_LOADERS',
+                   'INSTALLED_APPS'):
+        _latest_templates.clear()
@@ -0,0 +1,105 @@
+from hashlib import md5
+from logging import getLogger
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.encoding import iri_to_uri
+
+from cms.utils import get_language_from_request
+
+from newsy.cache import bump_generation, get_generations, on_commit
+
+
+
+log = getLogger('newsy.pagecache')
+
+def item_generation(pk):
+    return 'item:%d' % (pk,)
+
+def bump_item_pages(pks):
+    """
+    Invalidates the cached pages that displayed any of the items ``pks``
+    once the current transaction has committed. Bumped any earlier, a page
+    rendered meanwhile from the old rows would be cached under the new
+    generation and outlive the change.
+    """
+    for pk in set(pks):
+        on_commit(bump_generation, item_generation(pk))
+
+def recording_dependencies(request):
+    """
+    Returns whether the dependencies of the page rendered for ``request``
+    are being recorded, that is whether it may be stored.
+    """
+    return getattr(request, '_newsy_dependencies', None) is not None
+
+def record_dependencies(request, *names):
+    """
+    Declares that the page being rendered for ``request`` shows content
+    cached under the generation counters ``names``, so that bumping any of
+    them purges the page from the NEWSY_PAGE_CACHE.
+    
+    The counters are read when a name is first recorded and the page is
+    stored under those values, so record a name before loading the content
+    depending on it: a change committed meanwhile then invalidates the page.
+    """
+    dependencies = getattr(request, '_newsy_dependencies', None)
+    if dependencies is not None:
+        names = [name for name in set(names) if name not in dependencies]
+        if names:
+            dependencies.update(zip(names, get_generations(names)))
+
+def is_cacheable(request):
+    if not getattr(settings, 'NEWSY_PAGE_CACHE', False):
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.user.is_authenticated():
+        return False
+    return not ('edit' in request.GET or 'preview' in request.GET)
+
+def page_cache_key(request):
+    return 'newsy:page:%s:%s:%s' % (settings.SITE_ID,
+        get_language_from_request(request),
+        md5(iri_to_uri(request.get_full_path())).hexdigest(),)
+
+def get_cached_page(request):
+    """
+    Returns the cached response for ``request``, or ``None`` when there is
+    none or one of the generation counters it depends on changed since.
+    Starts recording the dependencies of the page otherwise.
+    """
+    if not is_cacheable(request):
+        return None
+    cached = cache.get(page_cache_key(request))
+    if cached is not None:
+        names, generation, content, headers = cached
+        if get_generations(names) == generation:
+            log.debug('get_cached_page(%s): hit' % (request.path,))
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            return response
+    request._newsy_dependencies = {}
+    record_dependencies(request, *getattr(settings,
+        'NEWSY_PAGE_CACHE_DEPENDENCIES', ()))
+    return None
+
+def cache_page(request, response):
+    """
+    Stores ``response`` under the dependencies recorded while rendering it,
+    with the generations read when they were recorded, for NEWSY_PAGE_CACHE_TIMEOUT seconds, ten minutes by default, so that a
+    page missed by an invalidation does not live long.
+    Responses setting cookies, such as a CSRF token, are never stored.
+    """
+    dependencies = getattr(request, '_newsy_dependencies', None)
+    if dependencies is None or response.status_code != 200 or \
+            response.cookies or request.META.get('CSRF_COOKIE_USED', False):
+        return response
+    names = tuple(sorted(dependencies))
+    cache.set(page_cache_key(request), (names, tuple(dependencies[name]
+                                                     for name in names),
+                                        response.content, response.items()),
+              getattr(settings, 'NEWSY_PAGE_CACHE_TIMEOUT', 600))
+    return response
@@ -0,0 +1,106 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+
+
+EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(item, backwards=False, pk_field='pk'):
+    """
+    Returns an opaque token pointing before (``backwards``) or after ``item``
+    in a list ordered by descending (publication_date, ``pk_field``).
+    """
+    pub = item.publication_date
+    micros = timegm(pub.utctimetuple()) * 1000000 + pub.microsecond
+    return urlsafe_b64encode('%s:%d:%d' % ('b' if backwards else 'f', micros,
+                                item.serializable_value(pk_field))).rstrip('=')
+
+def decode_cursor(token):
+    """
+    Returns the ``(backwards, publication_date, pk)`` encoded in a token from
+    ``encode_cursor``. Raises a ValueError for invalid tokens.
+    """
+    try:
+        direction, micros, pk = urlsafe_b64decode(
+            str(token) + '=' * (-len(token) % 4)).split(':')
+        if direction not in ('b', 'f'):
+            raise ValueError('Invalid cursor direction')
+        pub = EPOCH + timedelta(microseconds=int(micros))
+        pk = int(pk)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Invalid cursor: %r' % (token,))
+    if settings.USE_TZ:
+        pub = timezone.make_aware(pub, timezone.utc)
+    return direction == 'b', pub, pk
+
+class CursorPaginator(object):
+    """
+    Pages through a queryset on (publication_date, pk) instead of with an
+    OFFSET so that every page costs the same single query. ``count`` is only
+    known when it is passed in, for example from a cached estimate. Pass the
+    ``pk_field`` that breaks ties when paging through tag index rows, whose
+    covering index ends with the item.
+    """
+    def __init__(self, queryset, per_page, count=None, pk_field='pk'):
+        self.queryset = queryset.order_by('-publication_date', '-' + pk_field)
+        self.per_page = per_page
+        self.count = count
+        self.pk_field = pk_field
+
+    def page(self, cursor=None):
+        backwards = False
+        qs = self.queryset
+        field = self.pk_field
+        if cursor:
+            backwards, pub, pk = decode_cursor(cursor)
+            if backwards:
+                qs = qs.filter(Q(publication_date__gt=pub) |
+                               Q(publication_date=pub, **{field + '__gt': pk})
+                               ).order_by('publication_date', field)
+            else:
+                qs = qs.filter(Q(publication_date__lt=pub) |
+                               Q(publication_date=pub, **{field + '__lt': pk}))
+
+        object_list = list(qs[:self.per_page + 1])
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+
+        next_cursor = previous_cursor = None
+        if object_list:
+            if backwards or more:
+                next_cursor = encode_cursor(object_list[-1], False, field)
+            if (backwards and more) or (not backwards and cursor):
+                previous_cursor = encode_cursor(object_list[0], True, field)
+        return CursorPage(object_list, next_cursor, previous_cursor, self)
+
+class CursorPage(object):
+    def __init__(self, object_list, next_cursor, previous_cursor, paginator):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __repr__(self):
+        return '<CursorPage of %d items>' % (len(self.object_list),)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
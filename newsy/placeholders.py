@@ -1,64 +1,271 @@
 # -*- coding: utf-8 -*-
+from hashlib import md5
 from logging import getLogger
 import warnings
 
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.dispatch import receiver
+from django.forms.widgets import Media
 from django.shortcuts import get_object_or_404
 from django.template import NodeList, TextNode, VariableNode, \
     TemplateSyntaxError
 from django.template.loader import get_template
 from django.template.loader_tags import ConstantIncludeNode, ExtendsNode, \
     BlockNode
+from django.test.signals import setting_changed
 from cms.exceptions import DuplicatePlaceholderWarning
 from cms.models import Page
 from cms.plugin_rendering import render_plugins
-from cms.plugins.utils import get_plugins
+from cms.plugins.utils import assign_plugins, get_plugins
 from cms.templatetags.cms_tags import Placeholder
-from cms.utils import get_cms_setting
+from cms.utils import get_cms_setting, get_language_from_request
 
+from newsy.cache import bump_generation, get_versioned, on_commit, \
+    set_versioned
 from newsy.models import NewsItem
+from newsy.pagecache import record_dependencies
+from newsy.surrogate import get_purge_backend, item_key, purge_surrogate_keys
 
 
 
 log = getLogger('newsy.placeholders')
 
-def get_newsitem_from_placeholder_if_exists(placeholder):
-    log.debug('get_newsitem_from_placeholder_if_exists(placeholder=%s)' % 
-              (unicode(placeholder),))
+_slot_templates = None
+_extra_contexts = {}
+
+def get_slot_template(slot):
+    """
+    Returns the NEWSY_TEMPLATES template declaring the placeholder ``slot``,
+    or None when no template or more than one declares it. The templates are
+    only scanned once per process.
+    """
+    global _slot_templates
+    if _slot_templates is None:
+        # inline import to prevent circular imports
+        from cms.utils.plugins import get_placeholders
+        templates = {}
+        for template, verbose_name in settings.NEWSY_TEMPLATES:
+            for slot_name in get_placeholders(template):
+                templates[slot_name] = None if slot_name in templates else template
+        _slot_templates = templates
+    return _slot_templates.get(slot, None)
+
+def get_extra_context(template, slot):
+    """
+    Returns the PLACEHOLDER_CONF extra_context for ``slot`` in ``template``,
+    falling back to the one for ``slot`` alone. The result is resolved once
+    per process until ``reload_placeholder_conf`` is called and must not be
+    modified.
+    """
     try:
-        return NewsItem.objects.get(placeholders=placeholder)
-    except (NewsItem.DoesNotExist, NewsItem.MultipleObjectsReturned):
-        return None
+        return _extra_contexts[(template, slot)]
+    except KeyError:
+        conf = get_cms_setting('PLACEHOLDER_CONF')
+        extra_context = conf.get("%s %s" % (template, slot), {}).get(
+            "extra_context", None)
+        if not extra_context:
+            extra_context = conf.get(slot, {}).get("extra_context", {})
+        _extra_contexts[(template, slot)] = extra_context
+        return extra_context
+
+def reload_placeholder_conf(**kwargs):
+    """
+    Forgets the resolved placeholder configuration and templates, for example
+    after the settings changed.
+    """
+    global _slot_templates
+    _slot_templates = None
+    _extra_contexts.clear()
+
+@receiver(setting_changed)
+def placeholder_settings_changed(setting, **kwargs):
+    if setting in ('CMS_PLACEHOLDER_CONF', 'NEWSY_TEMPLATES'):
+        reload_placeholder_conf()
+
+def get_item_placeholders(item, request=None):
+    """
+    Returns the placeholders of a news item by slot. With a request they are
+    loaded once per request and item pk, so every instance of the item in
+    the request shares them; views fill the registry when they load the item.
+    Without a request they are cached on the instance.
+    """
+    if request is not None:
+        if not hasattr(request, '_newsy_placeholders'):
+            request._newsy_placeholders = {}
+        if item.pk not in request._newsy_placeholders:
+            request._newsy_placeholders[item.pk] = get_item_placeholders(item)
+        return request._newsy_placeholders[item.pk]
+    
+    if not hasattr(item, '_tmp_placeholders_cache'):
+        item._tmp_placeholders_cache = dict((placeholder.slot, placeholder)
+            for placeholder in item.placeholders.all())
+    return item._tmp_placeholders_cache
+
+def iter_plugins(plugins):
+    """
+    Yields ``plugins`` and their child plugins, depth first.
+    """
+    for plugin in plugins:
+        yield plugin
+        for child in iter_plugins(getattr(plugin, 'child_plugin_instances',
+                                          None) or []):
+            yield child
+
+def prefetch_plugins(request, placeholders, lang):
+    """
+    Loads the plugins of all ``placeholders`` with cms' ``assign_plugins``,
+    which takes one query for the plugins and one per plugin type for their
+    instances, honours the language fallbacks and nests the child plugins in
+    ``child_plugin_instances``. Returns the top level plugin instances by
+    placeholder pk, each plugin knowing its placeholder so that rendering
+    does not query it again.
+    """
+    log.debug('prefetch_plugins(placeholders=%s)' % (unicode(placeholders),))
+    assign_plugins(request, placeholders, lang)
+    plugins = {}
+    for placeholder in placeholders:
+        plugins[placeholder.pk] = placeholder._plugins_cache
+        for plugin in iter_plugins(placeholder._plugins_cache):
+            plugin._placeholder_cache = placeholder
+    return plugins
 
-def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder"):
+def get_newsy_plugins(request, placeholder, placeholders=None):
+    """
+    Returns the plugins of ``placeholder``. The first call for a request
+    prefetches the plugins of every placeholder in ``placeholders`` as well
+    and later calls for any of them are served from the request.
+    """
+    if request is None:
+        return list(get_plugins(request, placeholder))
+    lang = get_language_from_request(request)
+    if not hasattr(request, '_newsy_plugins_cache'):
+        request._newsy_plugins_cache = {}
+    cache = request._newsy_plugins_cache
+    if (lang, placeholder.pk) not in cache:
+        placeholders = list(placeholders or [])
+        if placeholder not in placeholders:
+            placeholders.append(placeholder)
+        for pk, plugins in prefetch_plugins(request, placeholders,
+                                            lang).iteritems():
+            cache[(lang, pk)] = plugins
+    return cache[(lang, placeholder.pk)]
+
+class AccumulatedMedia(Media):
+    """
+    A Media collecting js and css paths in order and without duplicates as
+    they are added, instead of rebuilding a Media for every addition. It is
+    only read once the page is rendered.
+    """
+    def __init__(self, media=None):
+        self._js = []
+        self._css = {}
+        self._seen = set()
+        if media is not None:
+            self.add(media)
+    
+    def add(self, media):
+        for path in media._js:
+            if ('js', path) not in self._seen:
+                self._seen.add(('js', path))
+                self._js.append(path)
+        for medium, paths in media._css.iteritems():
+            for path in paths:
+                if (medium, path) not in self._seen:
+                    self._seen.add((medium, path))
+                    self._css.setdefault(medium, []).append(path)
+
+def get_placeholder_media(request, context, plugins):
+    """
+    Returns the media of ``plugins`` and of their child plugins, like
+    ``placeholder.get_media``, from each plugin instance's
+    ``get_plugin_media``. The instances come from the prefetch, so collecting
+    it costs no query.
+    """
+    media = AccumulatedMedia()
+    for plugin in iter_plugins(plugins):
+        media.add(plugin.get_plugin_media(request, context))
+    return media
+
+def add_placeholder_media(request, media):
+    """
+    Adds ``media`` to the request's placeholder_media.
+    """
+    if not isinstance(request.placeholder_media, AccumulatedMedia):
+        request.placeholder_media = AccumulatedMedia(request.placeholder_media)
+    request.placeholder_media.add(media)
+
+def bump_placeholder_version(placeholder_id):
+    """
+    Invalidates the cached rendering of a placeholder after its plugins
+    changed once the change has committed, and purges the pages of its item
+    from the caching proxy.
+    """
+    on_commit(bump_generation, 'placeholder:%d' % (placeholder_id,))
+    if get_purge_backend() is not None:
+        purge_surrogate_keys([item_key(pk) for pk in NewsItem.objects.filter(
+            placeholders=placeholder_id).values_list('pk', flat=True)])
+
+def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder",
+                             placeholders=None, template=None):
     """
     Renders plugins for a placeholder on the given page using shallow copies of the 
     given context, and returns a string containing the rendered output.
+    
+    ``placeholders`` are the other placeholders of the same item, whose
+    plugins are prefetched along with those of ``placeholder``. ``template``
+    is the item's template, looked up from the placeholder slot if omitted.
+    
+    The media of the plugins is added to the request's placeholder_media.
+    
+    With NEWSY_PLACEHOLDER_CACHE the output is cached until the placeholder's
+    plugins or item change, except for placeholders holding a plugin type
+    listed in NEWSY_PLACEHOLDER_CACHE_EXCLUDE at any depth. The media is
+    cached with it, so that a cached placeholder costs no query at all.
     """
     log.debug('render_newsy_placeholder(placeholder=%s)' % 
               (unicode(placeholder),))
     request = context.get('request', None)
-    context.push()
-    plugins = list(get_plugins(request, placeholder))
-    page = get_newsitem_from_placeholder_if_exists(placeholder)
-    if page:
-        template = page.template
-    else:
-        template = None
+    record_dependencies(request, 'placeholder:%d' % (placeholder.pk,))
+    slot = getattr(placeholder, 'slot', None)
+    if template is None and slot:
+        template = get_slot_template(slot)
+    
+    cache_key = cached = None
+    if request is not None and getattr(settings, 'NEWSY_PLACEHOLDER_CACHE',
+                                       False):
+        cache_key = 'newsy:placeholder:%d:%s:%s' % (placeholder.pk,
+            get_language_from_request(request), md5(str(template)).hexdigest(),)
+        generation, cached = get_versioned('placeholder:%d' % (placeholder.pk,),
+                                           cache_key)
+    
+    if cached is not None:
+        if cached['content'] is not None:
+            if hasattr(request, 'placeholder_media'):
+                add_placeholder_media(request, cached['media'])
+            return cached['content']
+        cache_key = None
+    
+    plugins = get_newsy_plugins(request, placeholder, placeholders)
+    media = get_placeholder_media(request, context, plugins)
+    if hasattr(request, 'placeholder_media'):
+        add_placeholder_media(request, media)
+    
     # Add extra context as defined in settings, but do not overwrite existing context variables,
     # since settings are general and database/template are specific
     # TODO this should actually happen as a plugin context processor, but these currently overwrite 
     # existing context -- maybe change this order?
-    slot = getattr(placeholder, 'slot', None)
     extra_context = {}
     if slot:
-        extra_context = get_cms_setting('PLACEHOLDER_CONF').get("%s %s" % (template, slot), {}).get("extra_context", None)
-        if not extra_context:
-            extra_context = get_cms_setting('PLACEHOLDER_CONF').get(slot, {}).get("extra_context", {})
-    for key, value in extra_context.items():
-        if not key in context:
-            context[key] = value
+        extra_context = get_extra_context(template, slot)
+    for key in extra_context:
+        if key in context:
+            extra_context = dict((key, value) for key, value in
+                                 extra_context.iteritems() if key not in context)
+            break
+    # The shared extra context sits below an empty dict taking the writes
+    context.update(extra_context)
+    context.push()
 
     c = []
 
@@ -66,4 +273,18 @@ def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder"):
     c.extend(render_plugins(plugins, context, placeholder, processors))
     content = "".join(c)
     context.pop()
+    context.pop()
+    
+    if cache_key is not None:
+        excluded = getattr(settings, 'NEWSY_PLACEHOLDER_CACHE_EXCLUDE',
+                           ('CMSLatestNewsPlugin',))
+        # A plugin nested in a text or column plugin excludes it as well
+        if any(plugin.plugin_type in excluded
+               for plugin in iter_plugins(plugins)):
+            content_cached = None
+        else:
+            content_cached = content
+        set_versioned(cache_key, generation, {'content': content_cached,
+                                              'media': media},
+                      getattr(settings, 'NEWSY_PLACEHOLDER_CACHE_TIMEOUT', None))
     return content
@@ -1,9 +1,21 @@
 from datetime import datetime
 
-from django.db.models.signals import pre_save, post_save
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete, m2m_changed
 from django.dispatch import receiver
 
-from newsy.models import NewsItem
+from tagging.models import Tag
+
+from newsy.cache import bump_generation, on_commit
+from newsy.models import NewsItem, NewsItemTag, NewsItemThumbnail, \
+    RelatedNewsItem, TagCount, latest_news_generation, \
+    user_permission_generation
+from newsy.pagecache import bump_item_pages
+from newsy.surrogate import get_purge_backend, item_key, item_purge_keys, \
+    feed_key, site_key, purge_surrogate_keys
 
 
 
@@ -12,6 +24,274 @@ def set_publication_date_if_published(instance, **kwargs):
     if hasattr(instance, 'published') and instance.published and not instance.publication_date:
         instance.publication_date = datetime.now()
 
+@receiver(pre_save, sender=NewsItem)
+def remember_previous_state(instance, **kwargs):
+    instance._newsy_previous = (False, [], None)
+    instance._newsy_indexed_state = None
+    if instance.pk:
+        previous = NewsItem.objects.filter(pk=instance.pk).values_list(
+            'published', 'publication_date')
+        if previous:
+            instance._newsy_previous = (previous[0][0], [tag.name for tag in
+                Tag.objects.get_for_object(instance)], previous[0][1])
+            instance._newsy_indexed_state = (previous[0][0], previous[0][1],
+                frozenset(instance._newsy_previous[1]),
+                frozenset(instance.sites.values_list('pk', flat=True)))
+
+def _indexed_state(item):
+    """
+    Returns what the tag index and related items of ``item`` are computed
+    from: whether and when it is published, its tags and its sites.
+    """
+    return (item.published, item.publication_date, frozenset(tag.name for tag
+            in Tag.objects.get_for_object(item)),
+            frozenset(item.sites.values_list('pk', flat=True)))
+
+def _update_indexes(instance):
+    """
+    Rewrites the tag index and recomputes the related items around
+    ``instance`` when its state changed since they were last computed, so
+    that saving a title costs no rebuild.
+    """
+    state = _indexed_state(instance)
+    if state != getattr(instance, '_newsy_indexed_state', None):
+        NewsItemTag.objects.sync(instance)
+        RelatedNewsItem.objects.refresh(instance)
+        instance._newsy_indexed_state = state
+
+def _update_indexes_on_commit(instance):
+    if NewsItem.objects.filter(pk=instance.pk).exists():
+        _update_indexes(instance)
+
+def _neighbour_pks(item):
+    if hasattr(item, '_published_neighbours'):
+        del item._published_neighbours
+    return [neighbour.pk for neighbour in item.get_published_neighbours()
+            if neighbour is not None]
+
+@receiver(pre_save, sender=NewsItem)
+@receiver(pre_delete, sender=NewsItem)
+def remember_neighbours(instance, **kwargs):
+    instance._newsy_neighbours = []
+    if instance.pk and (getattr(settings, 'NEWSY_PAGE_CACHE', False) or
+                        get_purge_backend() is not None):
+        try:
+            previous = NewsItem.objects.get(pk=instance.pk)
+        except NewsItem.DoesNotExist:
+            return
+        instance._newsy_neighbours = _neighbour_pks(previous)
+
 @receiver(post_save, sender=NewsItem)
 def update_placeholders(instance, **kwargs):
-    instance.rescan_placeholders()
\ No newline at end of file
+    instance.rescan_placeholders()
+
+@receiver(post_save, sender=NewsItem)
+def update_tag_index(instance, **kwargs):
+    _update_indexes(instance)
+
+@receiver(pre_delete, sender=NewsItem)
+def remember_tag_index(instance, **kwargs):
+    instance._newsy_tag_index = list(NewsItemTag.objects.filter(
+        newsitem=instance).values_list('tag', 'site'))
+
+@receiver(post_delete, sender=NewsItem)
+def update_tag_counts_on_delete(instance, **kwargs):
+    index = getattr(instance, '_newsy_tag_index', [])
+    if index:
+        TagCount.objects.recount(set(t for t, s in index),
+                                 set(s for t, s in index))
+
+@receiver(pre_delete, sender=NewsItem)
+def remember_related(instance, **kwargs):
+    instance._newsy_related = list(RelatedNewsItem.objects.filter(
+        related=instance).values_list('newsitem', 'site').distinct())
+
+@receiver(post_delete, sender=NewsItem)
+def update_related_on_delete(instance, **kwargs):
+    for pk, site_id in getattr(instance, '_newsy_related', [])[:getattr(
+            settings, 'NEWSY_RELATED_REFRESH_LIMIT', 50)]:
+        try:
+            item = NewsItem.objects.get(pk=pk)
+        except NewsItem.DoesNotExist:
+            continue
+        RelatedNewsItem.objects.rebuild(item, site_id)
+
+@receiver(post_save, sender=NewsItem)
+def invalidate_placeholders(instance, **kwargs):
+    if getattr(settings, 'NEWSY_PLACEHOLDER_CACHE', False):
+        for pk in instance.placeholders.values_list('pk', flat=True):
+            on_commit(bump_generation, 'placeholder:%d' % (pk,))
+
+def _menu_changed(item):
+    if getattr(settings, 'NEWSY_MENU_INCREMENTAL', False):
+        # inline import to prevent circular imports
+        from newsy.menu import patch_cached_menus
+        on_commit(patch_cached_menus, item.pk)
+    else:
+        on_commit(bump_generation, 'menu')
+
+@receiver(post_save, sender=NewsItem)
+def invalidate_menu(instance, **kwargs):
+    _menu_changed(instance)
+
+@receiver(post_delete, sender=NewsItem)
+def invalidate_menu_on_delete(instance, **kwargs):
+    _menu_changed(instance)
+
+@receiver(post_save, sender=NewsItem)
+@receiver(post_delete, sender=NewsItem)
+def invalidate_pages(instance, **kwargs):
+    if not getattr(settings, 'NEWSY_PAGE_CACHE', False):
+        return
+    pks = [instance.pk] + getattr(instance, '_newsy_neighbours', [])
+    if kwargs['signal'] is post_save:
+        pks.extend(_neighbour_pks(instance))
+    bump_item_pages(pks)
+
+@receiver(pre_delete, sender=NewsItem)
+def remember_sites(instance, **kwargs):
+    instance._newsy_sites = list(instance.sites.values_list('pk', flat=True))
+
+@receiver(post_save, sender=NewsItem)
+@receiver(post_delete, sender=NewsItem)
+def purge_surrogates(instance, **kwargs):
+    if get_purge_backend() is None:
+        return
+    # The old neighbours link to the item until their pages are purged
+    keys = set(item_key(pk) for pk in [instance.pk] +
+               getattr(instance, '_newsy_neighbours', []))
+    if kwargs['signal'] is post_save:
+        published, tag_names, publication_date = getattr(instance,
+            '_newsy_previous', (False, [], None))
+        site_ids = instance.sites.values_list('pk', flat=True)
+        keys.update(item_key(pk) for pk in _neighbour_pks(instance))
+    else:
+        published, tag_names, publication_date = (False, [], None)
+        site_ids = getattr(instance, '_newsy_sites', [])
+    if published or instance.published:
+        keys.update(item_purge_keys(site_ids, tag_names + [tag.name for tag in
+            Tag.objects.get_for_object(instance)],
+            [publication_date, instance.publication_date]))
+    purge_surrogate_keys(keys)
+
+@receiver(post_save, sender=NewsItemThumbnail)
+@receiver(post_delete, sender=NewsItemThumbnail)
+def purge_thumbnail_surrogates(instance, **kwargs):
+    if get_purge_backend() is not None:
+        purge_surrogate_keys([item_key(instance.news_item_id)] + [
+            feed_key(site_id) for site_id in NewsItem.sites.through.objects
+                .filter(newsitem=instance.news_item_id)
+                .values_list('site', flat=True)])
+
+@receiver(post_save, sender=NewsItemThumbnail)
+@receiver(post_delete, sender=NewsItemThumbnail)
+def invalidate_thumbnail_pages(instance, **kwargs):
+    if getattr(settings, 'NEWSY_PAGE_CACHE', False):
+        bump_item_pages([instance.news_item_id])
+
+@receiver(post_save, sender=NewsItem)
+@receiver(post_delete, sender=NewsItem)
+def invalidate_listings(instance, **kwargs):
+    on_commit(bump_generation, 'listing')
+
+@receiver(post_save, sender=NewsItem)
+@receiver(post_delete, sender=NewsItem)
+@receiver(post_save, sender=NewsItemThumbnail)
+@receiver(post_delete, sender=NewsItemThumbnail)
+def invalidate_feeds(instance, **kwargs):
+    on_commit(bump_generation, 'feeds')
+
+def _latest_news_changed(tag_names):
+    for name in set(tag_names):
+        on_commit(bump_generation, latest_news_generation(name))
+    on_commit(bump_generation, latest_news_generation())
+
+@receiver(post_save, sender=NewsItem)
+def invalidate_latest_news(instance, **kwargs):
+    published, tag_names, publication_date = getattr(instance,
+        '_newsy_previous', (False, [], None))
+    if published or instance.published:
+        _latest_news_changed(tag_names + [tag.name for tag in
+                                          Tag.objects.get_for_object(instance)])
+
+@receiver(post_delete, sender=NewsItem)
+def invalidate_latest_news_on_delete(instance, **kwargs):
+    if instance.published:
+        _latest_news_changed([tag.name for tag in
+                              Tag.objects.get_for_object(instance)])
+
+def _purge_for_sites(instance, action, reverse, pk_set):
+    if reverse:
+        keys = item_purge_keys([instance.pk])
+        keys.update(item_key(pk) for pk in pk_set or [])
+        if action == 'post_clear':
+            keys.add(site_key(instance.pk))
+    else:
+        keys = set([item_key(instance.pk)])
+        if instance.published:
+            keys.update(item_purge_keys(pk_set or instance.sites.values_list(
+                'pk', flat=True), [tag.name for tag in
+                    Tag.objects.get_for_object(instance)],
+                [instance.publication_date]))
+    purge_surrogate_keys(keys)
+
+@receiver(m2m_changed, sender=NewsItem.sites.through)
+def invalidate_for_sites(instance, action, reverse, pk_set, **kwargs):
+    if not reverse and not hasattr(instance, '_newsy_indexed_state'):
+        instance._newsy_indexed_state = _indexed_state(instance)
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        if action == 'post_clear':
+            NewsItemTag.objects.filter(site=instance).delete()
+            TagCount.objects.filter(site=instance).delete()
+            RelatedNewsItem.objects.filter(site=instance).delete()
+        for item in NewsItem.objects.filter(pk__in=pk_set or []):
+            NewsItemTag.objects.sync(item)
+            RelatedNewsItem.objects.refresh(item)
+        on_commit(bump_generation, 'menu')
+        items = NewsItem.objects.filter(pk__in=pk_set or [], published=True)
+    else:
+        if action == 'post_clear':
+            # Setting the sites clears them before adding the new ones, so
+            # the indexes are only compared once the new sites are known
+            on_commit(_update_indexes_on_commit, instance)
+        else:
+            _update_indexes(instance)
+        _menu_changed(instance)
+        items = [instance] if instance.published else []
+    on_commit(bump_generation, 'feeds')
+    on_commit(bump_generation, 'listing')
+    if getattr(settings, 'NEWSY_PAGE_CACHE', False):
+        bump_item_pages([instance.pk] if not reverse else pk_set or [])
+    if get_purge_backend() is not None:
+        _purge_for_sites(instance, action, reverse, pk_set)
+    _latest_news_changed([tag.name for item in items
+                          for tag in Tag.objects.get_for_object(item)])
+
+@receiver(post_save)
+def invalidate_user_permissions(sender, instance, **kwargs):
+    if issubclass(sender, get_user_model()):
+        on_commit(bump_generation, user_permission_generation(instance.pk))
+
+@receiver(m2m_changed)
+def invalidate_membership_permissions(instance, action, reverse, model, pk_set,
+                                      **kwargs):
+    # The user model is looked up when it changes since it may be swapped
+    if not action.startswith('post_'):
+        return
+    User = get_user_model()
+    if not reverse and isinstance(instance, User):
+        on_commit(bump_generation, user_permission_generation(instance.pk))
+    elif reverse and issubclass(model, User):
+        if pk_set is None:
+            on_commit(bump_generation, 'permissions')
+        else:
+            for pk in pk_set:
+                on_commit(bump_generation, user_permission_generation(pk))
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_delete, sender=Group)
+def invalidate_group_permissions(**kwargs):
+    if kwargs.get('action', 'post_delete').startswith('post_'):
+        on_commit(bump_generation, 'permissions')
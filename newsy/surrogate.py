@@ -0,0 +1,185 @@
+from logging import getLogger
+import urllib2
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.http import urlquote
+from django.utils.importlib import import_module
+
+from newsy.cache import on_commit_batch
+
+
+log = getLogger('newsy.surrogate')
+
+_purge_backend = None
+
+def site_key(site_id=None):
+    return 'newsy-site-%s' % (site_id or settings.SITE_ID,)
+
+def item_key(pk):
+    return 'newsy-item-%d' % (pk,)
+
+def list_key(site_id=None):
+    return 'newsy-%s-list' % (site_id or settings.SITE_ID,)
+
+def feed_key(site_id=None):
+    return 'newsy-%s-feed' % (site_id or settings.SITE_ID,)
+
+def tags_key(site_id=None):
+    return 'newsy-%s-tags' % (site_id or settings.SITE_ID,)
+
+def tag_key(name, site_id=None):
+    return 'newsy-%s-tag-%s' % (site_id or settings.SITE_ID,
+                                urlquote(name, safe=''),)
+
+def month_key(year, month, site_id=None):
+    return 'newsy-%s-month-%04d-%02d' % (site_id or settings.SITE_ID,
+                                         int(year), int(month),)
+
+def latest_key(tag_name=None, site_id=None):
+    if tag_name is None:
+        return 'newsy-%s-latest' % (site_id or settings.SITE_ID,)
+    return 'newsy-%s-latest-%s' % (site_id or settings.SITE_ID,
+                                   urlquote(tag_name, safe=''),)
+
+def record_surrogate_keys(request, *keys):
+    """
+    Adds ``keys`` to the surrogate keys of the response being rendered for
+    ``request``, for parts of the page that do not know about the response
+    such as plugins.
+    """
+    if request is None:
+        return
+    if not hasattr(request, '_newsy_surrogate_keys'):
+        setattr(request, '_newsy_surrogate_keys', set())
+    request._newsy_surrogate_keys.update(keys)
+
+def add_surrogate_keys(response, keys, request=None):
+    """
+    Lists ``keys``, those recorded for ``request`` and the site's key in the
+    NEWSY_SURROGATE_KEY_HEADER of ``response`` when NEWSY_SURROGATE_KEYS is
+    set, so that a caching proxy can purge it by any of them.
+    """
+    if not getattr(settings, 'NEWSY_SURROGATE_KEYS', False):
+        return response
+    header = getattr(settings, 'NEWSY_SURROGATE_KEY_HEADER', 'Surrogate-Key')
+    keys = set(keys) | set([site_key()])
+    keys.update(getattr(request, '_newsy_surrogate_keys', ()))
+    if response.has_header(header):
+        keys.update(response[header].split())
+    response[header] = ' '.join(sorted(keys))
+    return response
+
+def item_purge_keys(site_ids, tag_names=(), dates=()):
+    """
+    Returns the keys of the listings on ``site_ids`` showing an item with
+    ``tag_names`` published on one of ``dates``, used when such an item is
+    published, changed or withdrawn.
+    """
+    keys = set()
+    for site_id in site_ids:
+        keys.update([list_key(site_id), feed_key(site_id),
+                     tags_key(site_id), latest_key(None, site_id)])
+        for name in tag_names:
+            keys.update([tag_key(name, site_id), latest_key(name, site_id)])
+        for pub in dates:
+            if pub is not None:
+                keys.add(month_key(pub.year, pub.month, site_id))
+    return keys
+
+class BasePurgeBackend(object):
+    """
+    Purges the responses tagged with any of a list of surrogate keys from a
+    caching proxy. Subclasses are named by NEWSY_PURGE_BACKEND.
+    """
+    def purge(self, keys):
+        raise NotImplementedError
+
+class LocMemPurgeBackend(BasePurgeBackend):
+    """
+    Only remembers the purged keys in ``purged``, for tests.
+    """
+    def __init__(self):
+        self.purged = []
+
+    def purge(self, keys):
+        self.purged.extend(keys)
+
+class PurgeRequest(urllib2.Request):
+    def __init__(self, url, method, headers):
+        urllib2.Request.__init__(self, url, headers=headers)
+        self.method = method
+
+    def get_method(self):
+        return self.method
+
+class HttpPurgeBackend(BasePurgeBackend):
+    """
+    Sends the keys in the NEWSY_SURROGATE_KEY_HEADER of a request with the
+    NEWSY_PURGE_METHOD to NEWSY_PURGE_URL, which defaults to a proxy on the
+    local host. Keys are sent NEWSY_PURGE_BATCH_SIZE at a time, waiting at
+    most NEWSY_PURGE_TIMEOUT seconds for each request. The
+    run_newsy_purge_server command stands in for the proxy locally.
+    """
+    def purge(self, keys):
+        url = getattr(settings, 'NEWSY_PURGE_URL', 'http://127.0.0.1:6081/')
+        method = getattr(settings, 'NEWSY_PURGE_METHOD', 'PURGE')
+        header = getattr(settings, 'NEWSY_SURROGATE_KEY_HEADER',
+                         'Surrogate-Key')
+        size = getattr(settings, 'NEWSY_PURGE_BATCH_SIZE', 100)
+        for i in range(0, len(keys), size):
+            urllib2.urlopen(PurgeRequest(url, method,
+                {header: ' '.join(keys[i:i + size])}),
+                timeout=getattr(settings, 'NEWSY_PURGE_TIMEOUT', 1)).close()
+
+def get_purge_backend():
+    """
+    Returns an instance of the NEWSY_PURGE_BACKEND class, or None when no
+    backend is configured.
+    """
+    global _purge_backend
+    path = getattr(settings, 'NEWSY_PURGE_BACKEND', None)
+    if not path:
+        return None
+    if _purge_backend is None:
+        module, name = path.rsplit('.', 1)
+        try:
+            _purge_backend = getattr(import_module(module), name)()
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured('Error loading purge backend %s: %s'
+                                       % (path, e,))
+    return _purge_backend
+
+def purge_surrogate_keys(keys):
+    """
+    Purges the responses tagged with any of ``keys`` through the configured
+    backend once the current transaction has committed. The keys queued
+    during a request are sent together after its response, so saving never
+    waits for the proxy, which cannot cache the old content again either.
+    """
+    if get_purge_backend() is not None:
+        on_commit_batch(send_purges, keys)
+
+def send_purges(keys):
+    """
+    Sends ``keys`` to the configured backend. Failures are logged rather
+    than raised so that saving content never fails because the proxy is
+    unreachable.
+    """
+    keys = sorted(keys)
+    backend = get_purge_backend()
+    if backend is None or not keys:
+        return
+    log.debug('send_purges(%s)' % (' '.join(keys),))
+    try:
+        backend.purge(keys)
+    except Exception:
+        log.exception('Failed to purge %d surrogate keys' % (len(keys),))
+
+@receiver(setting_changed)
+def purge_settings_changed(setting, **kwargs):
+    global _purge_backend
+    if setting == 'NEWSY_PURGE_BACKEND':
+        _purge_backend = None
@@ -1,27 +1,19 @@
-import operator
 from logging import getLogger
 
 from django import template
 
 from cms.templatetags.cms_tags import Placeholder
 
-from newsy.placeholders import render_newsy_placeholder
+from newsy.placeholders import render_newsy_placeholder, \
+    get_item_placeholders
 
 
 
 log = getLogger('newsy.templatetags.newsy_tags')
 register = template.Library()
 
-def _get_placeholder(page, name):
-    if not hasattr(page, '_tmp_placeholders_cache'):
-        cache = {}
-        
-        for placeholder in page.placeholders.all():
-            cache[placeholder.slot] = placeholder
-        
-        page._tmp_placeholders_cache = cache
-    
-    return page._tmp_placeholders_cache.get(name, None)
+def _get_placeholder(page, name, request=None):
+    return get_item_placeholders(page, request).get(name, None)
 
 class NewsyPlaceholder(Placeholder):
     name='newsy_placeholder'
@@ -47,14 +39,14 @@ class NewsyPlaceholder(Placeholder):
         if width:
             context.update({'width': width})
         
-        placeholder = _get_placeholder(context['current_page'], name)
+        request = context.get('request', None)
+        placeholder = _get_placeholder(context['current_page'], name, request)
         
         if placeholder:
-            request = context.get('request', None)
-            if request and hasattr(request, 'placeholder_media'):
-                request.placeholder_media = reduce(operator.add, [request.placeholder_media, placeholder.get_media(request, context)])
-        
-            content = render_newsy_placeholder(placeholder, context, name)
+            page = context['current_page']
+            placeholders = get_item_placeholders(page, request).values()
+            content = render_newsy_placeholder(placeholder, context, name,
+                placeholders, page.get_template())
         else:
             content = None
         
@@ -24,6 +24,8 @@ urlpatterns = patterns('newsy.views',
     url(r'^rss/', RssNewsItemFeed(), name='newsy-rss-feed'),
     url(r'^tag/(?P<tag>[\d\w\- &]{1,64})/rss/$', RssNewsItemFeed(),
         name='newsy-rss-tag-feed'),
+    url(r'^cascade/rss/archive/$', RssCascadeNewsFeed(limit=0, streaming=True),
+        name='cascade-rss-archive-feed'),
     url(r'^cascade/rss/', RssCascadeNewsFeed(), name='cascade-rss-feed'),
     url(r'^tag/(?P<tag>[\d\w\- &]{1,64})/cascade/rss/$', RssCascadeNewsFeed(),
         name='cascade-rss-tag-feed'),
@@ -1,22 +1,66 @@
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from hashlib import md5
 
+from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.http import Http404, HttpResponseServerError, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
+from django.utils import timezone
+from django.utils.encoding import smart_str
 from django.views.generic.list import ListView
 
 from cms.utils import get_language_from_request
 
-from tagging.models import TaggedItem, Tag
+from newsy.cache import get_versioned, set_versioned
+from newsy.models import NewsItem, NewsItemTag, TagCount
+from newsy.pagecache import cache_page, get_cached_page, item_generation, \
+    record_dependencies, recording_dependencies
+from newsy.pagination import CursorPaginator
+from newsy.surrogate import add_surrogate_keys, item_key, list_key, month_key, \
+    tag_key, tags_key
+from newsy.placeholders import get_item_placeholders
 
-from newsy.models import NewsItem
 
 
+def publication_date_filters(year, month=None, day=None):
+    """
+    Returns the filters selecting the items published on the given year,
+    month or day as a half-open range on publication_date, which unlike the
+    __year/__month/__day lookups can use the column's index. The bounds are
+    in UTC like those lookups and the dates in the item URLs and menu. Raises
+    a ValueError for dates that do not exist.
+    """
+    year = int(year)
+    if month:
+        month = int(month)
+        if day:
+            start = datetime(year, month, int(day))
+            end = start + timedelta(days=1)
+        else:
+            start = datetime(year, month, 1)
+            end = datetime(year + month // 12, month % 12 + 1, 1)
+    else:
+        start = datetime(year, 1, 1)
+        end = datetime(year + 1, 1, 1)
+    
+    if settings.USE_TZ:
+        start = timezone.make_aware(start, timezone.utc)
+        end = timezone.make_aware(end, timezone.utc)
+    
+    return {'publication_date__gte': start, 'publication_date__lt': end}
 
 class NewsListView(ListView):
+    """
+    Lists news items, optionally filtered by tag and date. With
+    ``cursor_pagination`` pages are addressed by opaque ``cursor`` tokens
+    on (publication_date, pk) instead of page numbers, and the paginator's
+    count is a cached count when ``cursor_count`` is set and None otherwise.
+    """
     queryset = NewsItem.site_objects
     published = True
+    cursor_pagination = False
+    cursor_count = False
     
     def get_tags(self):
         tags = getattr(self, 'tags', [])
@@ -27,36 +71,89 @@ class NewsListView(ListView):
         return tags
     
     def get_date_filters(self):
-        filters = {}
         kwargs = getattr(self, 'kwargs', {})
-        if kwargs.get('year', None):
-            filters['publication_date__year'] = kwargs['year']
-        if kwargs.get('month', None):
-            filters['publication_date__month'] = kwargs['month']
-        if kwargs.get('day', None):
-            filters['publication_date__day'] = kwargs['day']
-        return filters
+        if not kwargs.get('year', None):
+            return {}
+        try:
+            return publication_date_filters(kwargs['year'],
+                                            kwargs.get('month', None),
+                                            kwargs.get('day', None))
+        except ValueError:
+            raise Http404()
     
     def get_queryset(self):
-        qs = super(NewsListView, self).get_queryset()
-        kwargs = getattr(self, 'kwargs', {})
-        
-        if getattr(self, 'published', True):
-            qs = qs.filter(published=True)
-        else:
-            qs = qs.filter(published=False)
-        
+        """
+        Returns the items or, when filtering by tag, the rows of the tag index
+        which carry the same publication_date and published columns. Those
+        are only replaced by their items once paginated.
+        """
+        published = getattr(self, 'published', True)
         tags = self.get_tags()
         date_filters = self.get_date_filters()
         
         if tags:
-            qs = TaggedItem.objects.get_by_model(qs, tags)
+            qs = NewsItemTag.objects.tagged(tags, published=published)
+        else:
+            qs = super(NewsListView, self).get_queryset().filter(
+                published=published)
         
         if date_filters:
             qs = qs.filter(**date_filters)
         
         return qs
     
+    def paginate_queryset(self, queryset, page_size):
+        tagged = queryset.model is NewsItemTag
+        if not self.cursor_pagination:
+            paginator, page, object_list, is_paginated = super(NewsListView,
+                self).paginate_queryset(queryset, page_size)
+        else:
+            count = None
+            if self.cursor_count:
+                count = self.get_cached_count(queryset)
+            paginator = CursorPaginator(queryset, page_size, count,
+                                        'newsitem' if tagged else 'pk')
+            try:
+                page = paginator.page(self.request.GET.get('cursor', None))
+            except ValueError:
+                raise Http404()
+            is_paginated = page.has_other_pages()
+        
+        if tagged:
+            page.object_list = NewsItemTag.objects.get_items(page.object_list)
+        return (paginator, page, page.object_list, is_paginated)
+    
+    def get_cached_count(self, queryset):
+        key = 'newsy:count:%s' % (md5(smart_str(queryset.query)).hexdigest(),)
+        generation, count = get_versioned('listing', key)
+        if count is None:
+            count = queryset.count()
+            set_versioned(key, generation, count)
+        return count
+    
+    def get_surrogate_keys(self, context):
+        """
+        Returns the surrogate keys of the listing: its items and either its
+        tags, its archive months or, when unfiltered, the site's listings.
+        """
+        keys = [item_key(item.pk) for item in context['object_list']]
+        tags = self.get_tags()
+        keys.extend(tag_key(name) for name in tags)
+        year = getattr(self, 'kwargs', {}).get('year', None)
+        if year:
+            month = getattr(self, 'kwargs', {}).get('month', None)
+            keys.extend(month_key(year, m) for m in
+                        ([month] if month else range(1, 13)))
+        elif not tags:
+            keys.append(list_key())
+        return keys
+    
+    def render_to_response(self, context, **response_kwargs):
+        response = super(NewsListView, self).render_to_response(context,
+            **response_kwargs)
+        return add_surrogate_keys(response, self.get_surrogate_keys(context),
+                                  self.request)
+    
     def get_context_data(self, **kwargs):
         context = super(NewsListView, self).get_context_data(**kwargs)
         tags = self.get_tags()
@@ -68,35 +165,58 @@ class NewsListView(ListView):
 
         return context
 
-item_list = NewsListView.as_view(paginate_by=15)
+item_list = NewsListView.as_view(paginate_by=15,
+    cursor_pagination=getattr(settings, 'NEWSY_CURSOR_PAGINATION', False),
+    cursor_count=getattr(settings, 'NEWSY_CURSOR_COUNT', False))
 upcoming_item_list = permission_required('newsy.change_newsitem')(
     NewsListView.as_view(published=False, paginate_by=15))
 
 def item_view(request, year, month, day, slug):
+    response = get_cached_page(request)
+    if response is not None:
+        return response
+    
     try:
-        page = NewsItem.objects.get(publication_date__year=year,
-                                    publication_date__month=month,
-                                    publication_date__day=day,
-                                    slug=slug)
+        filters = publication_date_filters(year, month, day)
+        if recording_dependencies(request):
+            # The generation is read before the item is loaded
+            record_dependencies(request, item_generation(
+                NewsItem.objects.values_list('pk', flat=True).get(slug=slug,
+                                                                  **filters)))
+        page = NewsItem.objects.prefetch_related('placeholders').get(
+            slug=slug, **filters)
     except NewsItem.MultipleObjectsReturned as e:
         raise Http404()
-    except NewsItem.DoesNotExist as e:
+    except (NewsItem.DoesNotExist, ValueError,) as e:
         try:
             page = NewsItem.objects.get(slug=slug)
             return HttpResponseRedirect(page.get_absolute_url())
         except (NewsItem.DoesNotExist, NewsItem.MultipleObjectsReturned,) as e:
             raise Http404()
 
+    get_item_placeholders(page, request)
     context = RequestContext(request)
     context['lang'] = get_language_from_request(request)
     context['current_page'] = page
     context['has_change_permissions'] = page.has_change_permission(request)
-    return render_to_response(page.template, context)
+    response = render_to_response(page.template, context)
+    if not page.published:
+        return response
+    
+    neighbours = [neighbour.pk for neighbour in
+                  getattr(page, '_published_neighbours', ())
+                  if neighbour is not None]
+    add_surrogate_keys(response, [item_key(pk) for pk in
+                                  [page.pk] + neighbours], request)
+    record_dependencies(request, *[item_generation(pk) for pk in
+                                   [page.pk] + neighbours])
+    return cache_page(request, response)
 
 @permission_required('newsy.change_newsitem')
 def unpublished_item_view(request, slug):
     try:
-        page = NewsItem.objects.get(published=False, slug=slug)
+        page = NewsItem.objects.prefetch_related('placeholders').get(
+            published=False, slug=slug)
     except NewsItem.DoesNotExist:
         raise Http404()
     except NewsItem.MultipleObjectsReturned:
@@ -106,6 +226,7 @@ def unpublished_item_view(request, slug):
     if not page.has_change_permission(request):
         raise Http404()
     #request._current_page_cache = page
+    get_item_placeholders(page, request)
     context = RequestContext(request)
     context['lang'] = get_language_from_request(request)
     context['current_page'] = page
@@ -114,12 +235,10 @@ def unpublished_item_view(request, slug):
 
 def archive_view(request, year, month=None, day=None, **kwargs):
     kwargs.setdefault('filters', {})
-    kwargs['filters']['publication_date__year'] = year
-    
-    if day:
-        kwargs['filters']['publication_date__day'] = day
-    if month:
-        kwargs['filters']['publication_date__month'] = month
+    try:
+        kwargs['filters'].update(publication_date_filters(year, month, day))
+    except ValueError:
+        raise Http404()
     
     return item_list(request, **kwargs)
 
@@ -127,9 +246,11 @@ class TagsView(ListView):
     template_name = 'newsy/tag_list.html'
 
     def get_queryset(self, *args, **kwargs):
-        return Tag.objects.usage_for_queryset(
-                NewsItem.site_objects.filter(published=True),
-                counts=True)
+        return TagCount.objects.for_site()
+    
+    def render_to_response(self, context, **response_kwargs):
+        return add_surrogate_keys(super(TagsView, self).render_to_response(
+            context, **response_kwargs), [tags_key()], self.request)
 
 tags_view = TagsView.as_view()
 
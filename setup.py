@@ -29,7 +29,8 @@ setup(
     zip_safe = False,
     install_requires = [
         'setuptools',
+        'Django>=1.5',
         'django-photologue',
-        'django-cms',
+        'django-cms>=2.4',
         'django-tagging']
 )